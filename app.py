@@ -1,6 +1,5 @@
 import argparse
 import gc
-import json
 import os
 import datetime
 import time
@@ -10,11 +9,14 @@ import torch
 import whisperx
 from pathvalidate import sanitize_filename
 
-import py7zr
-
+import asr
 import dicts
 import llm
+import llm_router
+import output
+import profiling
 import subs
+import tm
 from translate import SakuraLLMTranslator
 
 
@@ -30,16 +32,67 @@ def parse_arguments():
     parser.add_argument('--model_name_or_path', type=str, default=None)
     parser.add_argument('--use_gpu', action='store_true', default=False)
     parser.add_argument('--text_length', type=int, default=1024)
+    parser.add_argument('--n_parallel', type=int, default=1)
+    parser.add_argument('--llm_workers', type=int, default=1, help='本地 Sakura 进程数')
+    parser.add_argument('--llm_remote_workers', type=str, default=None, help='远程 worker 地址, 逗号分隔, 如 10.0.0.2:20234,10.0.0.3:20234')
+    parser.add_argument('--llm_worker_authkey', type=str, default=None)
     parser.add_argument('--translate_show_progress', action='store_true', default=False)
-    return parser.parse_args()
+    parser.add_argument('--trim_silence', action='store_true', default=False)
+    parser.add_argument('--progress_interval', type=float, default=0.5)
+    parser.add_argument('--translation_memory', type=str, default=None)
+    parser.add_argument('--translation_memory_threshold', type=float, default=0.85)
+    parser.add_argument('--speculative', type=str, default=None, choices=['prompt_lookup', 'draft'])
+    parser.add_argument('--draft_model_name_or_path', type=str, default=None)
+    parser.add_argument('--draft_num_pred_tokens', type=int, default=10)
+    parser.add_argument('--archive_format', type=str, default='7z', choices=output.ARCHIVE_FORMATS)
+    parser.add_argument('--debug_dump', type=str, default='gz', choices=output.DEBUG_DUMP_FORMATS)
+    parser.add_argument('--profile', action='store_true', default=False, help='所有任务都进行性能分析')
+    parser.add_argument('--profile_mode', type=str, default='sample', choices=profiling.PROFILE_MODES)
+    parser.add_argument('--profile_interval', type=float, default=0.005)
+    parser.add_argument('--profile_top', type=int, default=30)
+    args = parser.parse_args()
+    if args.llm_workers < 0:
+        parser.error("--llm_workers 不能小于 0")
+    if args.llm_workers == 0 and not args.llm_remote_workers:
+        parser.error("--llm_workers 0 时需要通过 --llm_remote_workers 指定远程 worker")
+    if args.llm_remote_workers and not args.llm_worker_authkey:
+        parser.error("使用 --llm_remote_workers 时需要指定 --llm_worker_authkey")
+    return args
 
 
 class Progress:
-    def __init__(self, current: float, total: float, desc: str, data: any):
+    def __init__(self, current: float, total: float, desc: str, data: any, index: int = None):
         self.current = float(current)
         self.total = float(total)
         self.desc = desc
         self.data = data
+        # data 对应的文件下标, 多个文件同时翻译时完成顺序和输入顺序不一定一致
+        self.index = index
+
+
+class ProgressReporter:
+    """
+    合并进度更新, 最多每 interval 秒输出一次, 并根据已测得的速度估计剩余时间
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._start = time.monotonic()
+        self._last = 0.0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
+
+    def eta(self, done: float, total: float) -> str:
+        elapsed = time.monotonic() - self._start
+        if done <= 0 or total <= done:
+            return ''
+        remaining = int(elapsed * (total - done) / done)
+        return f', 剩余约 {remaining // 60}分{remaining % 60:02d}秒'
 
 
 class App:
@@ -58,6 +111,10 @@ class App:
             model_name_or_path=args.model_name_or_path,
             use_gpu=args.use_gpu,
             text_length=args.text_length,
+            n_parallel=args.n_parallel,
+            speculative=args.speculative,
+            draft_model_name_or_path=args.draft_model_name_or_path,
+            draft_num_pred_tokens=args.draft_num_pred_tokens,
         )
         self.sakura_generation_config = llm.SakuraGenerationConfig(
             temperature=0.1,
@@ -67,32 +124,117 @@ class App:
             frequency_penalty=0.0,
         )
         self.translate_show_progress = args.translate_show_progress
+        self.trim_silence = args.trim_silence
+        self.progress_interval = args.progress_interval
+        self.archiver = output.Archiver(args.archive_format)
+        self.writer = output.Writer(debug_dump=args.debug_dump)
+        self.profile = args.profile
+        self.profile_mode = args.profile_mode
+        self.profile_interval = args.profile_interval
+        self.profile_top = args.profile_top
+        self.llm_workers = args.llm_workers
+        self.llm_remote_workers = args.llm_remote_workers.split(',') if args.llm_remote_workers else []
+        self.llm_worker_authkey = args.llm_worker_authkey
+        self.translation_memory = None
+        if args.translation_memory is not None:
+            self.translation_memory = tm.TranslationMemory(
+                args.translation_memory,
+                threshold=args.translation_memory_threshold,
+            )
 
     def current_output_dir(self) -> str:
         now = datetime.datetime.now()
         return os.path.join(self.output_dir, now.strftime("%Y%m"), now.strftime("%d"), now.strftime("%H%M%S"))
 
+    def _profiled(self, name: str, gen, profile: bool):
+        """
+        开启性能分析时, 结果保存在 debug 目录下每个任务单独的目录中
+        调用方需要 yield from, gradio 按是否为生成器函数决定是否流式输出
+        """
+        if not (profile or self.profile):
+            return (yield from gen)
+        profiler = profiling.JobProfiler(self.profile_mode, interval=self.profile_interval)
+        try:
+            return (yield from profiler.wrap(gen))
+        finally:
+            directory = os.path.join(self.debug_dir, 'profile', f'{name}_{time.time()}')
+            try:
+                profiler.save(directory, top=self.profile_top)
+                print(f"性能分析: 执行 {profiler.seconds:.1f}s, 结果保存在 {directory}")
+            except Exception as e:
+                print(f"warning, failed to save profile: {e}")
+
     def _transcribe_whisperx(self, files):
         yield Progress(0, len(files), f'初始化Whisper', None)
+        compute_type = asr.pick_compute_type(self.transcribe_device)
+        settings = {
+            "device": self.transcribe_device,
+            "compute_type": compute_type,
+            "chunk_size": 6,
+            "files": [],
+        }
+        try:
+            yield from self._transcribe_whisperx_files(files, compute_type, settings)
+        except BaseException as e:
+            settings["error"] = repr(e)
+            raise
+        finally:
+            # 不受 --debug_dump 影响, 任务失败时也要留下记录
+            self._write_settings('transcribe_settings', settings)
+
+    def _write_settings(self, name: str, settings: dict):
+        try:
+            os.makedirs(self.debug_dir, 0o755, exist_ok=True)
+            output.write_json(os.path.join(self.debug_dir, f'{name}_{time.time()}.json'), settings)
+        except Exception as e:
+            print(f"warning, failed to write {name}: {e}")
+
+    def _transcribe_whisperx_files(self, files, compute_type: str, settings: dict):
         transcribe_model = whisperx.load_model(
             self.transcribe_model, self.transcribe_device,
+            compute_type=compute_type,
             vad_options={'vad_onset': 0.4, 'vad_offset': 0.3})
         align_model, align_metadata = whisperx.load_align_model(language_code="ja", device=self.transcribe_device)
+        # 按模型加载后剩余的内存选 batch_size, OOM 时减半重试, 减小后的值用于之后的文件
+        batch_size = asr.pick_batch_size(self.transcribe_device, self.transcribe_model)
+        settings["initial_batch_size"] = batch_size
+        print(f"转录参数: compute_type={compute_type}, batch_size={batch_size}")
+        reporter = ProgressReporter(self.progress_interval)
         i = 0
         for file in files:
-            yield Progress(i, len(files), f'转录 ({i+1}/{len(files)})', None)
+            yield Progress(i, len(files), f'转录 ({i+1}/{len(files)}){reporter.eta(i, len(files))}', None)
+            file_settings = {"file": os.path.basename(file), "batch_size": batch_size, "oom_retries": 0}
+            settings["files"].append(file_settings)
             audio = whisperx.load_audio(file)
-            result = transcribe_model.transcribe(audio, language="ja", chunk_size=6, batch_size=8)
+            time_map = None
+            if self.trim_silence:
+                original_seconds = len(audio) / asr.SAMPLE_RATE
+                audio, time_map = asr.trim_silence(audio)
+            start = time.perf_counter()
+            while True:
+                try:
+                    result = transcribe_model.transcribe(audio, language="ja", chunk_size=6, batch_size=batch_size)
+                    break
+                except Exception as e:
+                    if not asr.is_oom(e) or batch_size <= 1:
+                        raise
+                    batch_size //= 2
+                    file_settings["batch_size"] = batch_size
+                    file_settings["oom_retries"] += 1
+                    print(f"转录内存不足, batch_size 减半至 {batch_size} 重试")
+                    gc.collect()
+                    torch.cuda.empty_cache()
             result = whisperx.align(result["segments"], align_model, align_metadata, audio, self.transcribe_device, return_char_alignments=False)
+            if time_map is not None:
+                time_map.remap(result)
+                elapsed = time.perf_counter() - start
+                removed = original_seconds - time_map.voiced_seconds
+                saved = elapsed * removed / time_map.voiced_seconds if time_map.voiced_seconds > 0 else 0.0
+                print(f"静音裁剪: 去掉 {removed:.1f}s / {original_seconds:.1f}s 音频, 预计节省转录时间 {saved:.1f}s")
             # debug out
-            try:
-                filename = sanitize_filename(os.path.basename(file))
-                filepath = os.path.join(self.debug_dir, f'{filename}_{time.time()}.json')
-                with open(filepath, "w", encoding='utf-8') as f:
-                    json.dump(result, f, ensure_ascii=False)
-            except Exception as e:
-                print(e)
-            yield Progress(i+1, len(files), f'转录 ({i+1}/{len(files)})', subs.Sub.from_fast_whisper(result))
+            filename = sanitize_filename(os.path.basename(file))
+            self.writer.write_debug_json(os.path.join(self.debug_dir, f'{filename}_{time.time()}'), result)
+            yield Progress(i+1, len(files), f'转录 ({i+1}/{len(files)})', subs.CompactSub.from_fast_whisper(result))
             gc.collect()
             torch.cuda.empty_cache()
             i += 1
@@ -102,96 +244,127 @@ class App:
         gc.collect()
         torch.cuda.empty_cache()
 
-    def _translate(self, ss):
-        yield Progress(0, len(ss), f'初始化SakuraLLM', None)
-        translator = SakuraLLMTranslator(
-            self.sakura_config,
-            self.sakura_generation_config,
-            show_progress=self.translate_show_progress,
-        )
-        i = 0
-        for sub in ss:
-            yield Progress(i, len(ss), f'翻译 ({i+1}/{len(ss)})', None)
-            for progress in translator.translate(sub):
+    def _translate(self, ss, total: int):
+        """
+        ss 可以是生成器, 文件在轮到它翻译时才加载
+        """
+        yield Progress(0, total, f'初始化SakuraLLM', None)
+        router = None
+        if self.llm_workers != 1 or len(self.llm_remote_workers) > 0:
+            router = llm_router.create(
+                self.sakura_config,
+                local=self.llm_workers,
+                remote=self.llm_remote_workers,
+                authkey=self.llm_worker_authkey,
+            )
+        translator = None
+        # 任务出错或者被 gradio 取消时也要关闭 worker 进程, 否则下一个任务会在旁边再加载一份模型
+        try:
+            translator = SakuraLLMTranslator(
+                self.sakura_config,
+                self.sakura_generation_config,
+                show_progress=self.translate_show_progress,
+                memory=self.translation_memory,
+                model=router,
+            )
+            reporter = ProgressReporter(self.progress_interval)
+            # 文件下标 -> [已翻译行数, 总行数], 用于估计剩余时间
+            lines = {}
+            done = 0
+            for index, progress in translator.translate_many(ss):
+                lines[index] = [progress.current, progress.total]
                 if progress.finish:
+                    done += 1
                     yield Progress(
-                        i + 1, len(ss),
-                        f'翻译 ({i + 1}/{len(ss)}), 行 ({int(progress.current)}/{int(progress.total)})',
+                        done, total,
+                        f'翻译 ({done}/{total}), 行 ({int(progress.current)}/{int(progress.total)})',
                         progress.data,
+                        index,
                     )
-                else:
+                elif reporter.ready():
+                    # 未开始的文件按已开始文件的平均行数估计
+                    lines_done = sum(current for current, _ in lines.values())
+                    lines_total = sum(n for _, n in lines.values())
+                    lines_total += lines_total / len(lines) * (total - len(lines))
                     yield Progress(
-                        i, len(ss),
-                        f'翻译 ({i + 1}/{len(ss)}), 行 ({int(progress.current)}/{int(progress.total)})',
+                        done, total,
+                        f'翻译 ({done + 1}/{total}), 行 ({int(progress.current)}/{int(progress.total)})'
+                        f'{reporter.eta(lines_done, lines_total)}',
                         None,
                     )
-            i += 1
-        del translator
-        gc.collect()
-        torch.cuda.empty_cache()
+        finally:
+            del translator
+            if router is not None:
+                router.close()
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def transcribe(self, files, formats, profile: bool = False):
+        yield from self._profiled('transcribe', self._transcribe_job(files, formats), profile)
 
-    def transcribe(self, files, formats):
+    def _transcribe_job(self, files, formats):
         if not files or len(files) == 0:
             return [], ''
         dicts.reload()
         output_dir = self.current_output_dir()
         output_transcribe_dir = os.path.join(output_dir, 'transcribe')
         os.makedirs(output_transcribe_dir, 0o755, exist_ok=True)
-        transcribes = []
+        transcribes = output.PendingFiles()
         i = 0
         for progress in self._transcribe_whisperx(files):
             if progress.data is None:
-                yield transcribes, progress.desc
+                # 文件列表没有变化时不重复发送
+                yield gr.update(), progress.desc
                 continue
             file = files[i]
-            curr_transcribes = subs.write_all(
+            transcribes.add(self.writer.write_sub(
                 subs.Sub(event.clean_ja() for event in progress.data), output_transcribe_dir, os.path.splitext(os.path.basename(file.name))[0], formats,
-            )
-            transcribes.extend(curr_transcribes)
+            ))
             i += 1
-            yield transcribes, progress.desc
+            yield transcribes.ready(), progress.desc
+        self.writer.flush()
+        transcribes = transcribes.wait()
         # archive
-        transcribe_archive_path = os.path.join(output_dir, '转录打包.7z')
-        with py7zr.SevenZipFile(transcribe_archive_path, 'w') as archive:
-            archive.writeall(output_transcribe_dir, "")
-        transcribes.append(transcribe_archive_path)
+        transcribes.append(self.archiver.submit(output_dir, '转录打包', [(output_transcribe_dir, "")]).result())
         yield transcribes, '结束'
 
-    def translate(self, files, formats):
+    def translate(self, files, formats, profile: bool = False):
+        yield from self._profiled('translate', self._translate_job(files, formats), profile)
+
+    def _translate_job(self, files, formats):
         if not files or len(files) == 0:
             return [], ''
         dicts.reload()
         output_dir = self.current_output_dir()
         output_translate_dir = os.path.join(output_dir, 'translate')
         os.makedirs(output_translate_dir, 0o755, exist_ok=True)
-        translates = []
-        i = 0
-        for progress in self._translate(list(subs.Sub.load_file(file) for file in files)):
+        translates = output.PendingFiles()
+        for progress in self._translate((subs.Sub.load_file(file) for file in files), len(files)):
             if progress.data is None:
-                yield translates, progress.desc
+                yield gr.update(), progress.desc
                 continue
             sub = progress.data
-            file = files[i]
+            file = files[progress.index]
             is_txt = os.path.splitext(file.name)[1].lstrip(".").lower() == 'txt'
             if is_txt:
-                curr_transcribes = subs.write_all(
+                translates.add(self.writer.write_sub(
                     sub, output_translate_dir, os.path.splitext(os.path.basename(file.name))[0], ['txt'],
-                )
+                ))
             else:
-                curr_transcribes = subs.write_all(
+                translates.add(self.writer.write_sub(
                     sub, output_translate_dir, os.path.splitext(os.path.basename(file.name))[0], formats,
-                )
-            translates.extend(curr_transcribes)
-            i += 1
-            yield translates, progress.desc
+                ))
+            yield translates.ready(), progress.desc
+        self.writer.flush()
+        translates = translates.wait()
         # archive
-        translate_archive_path = os.path.join(output_dir, '翻译打包.7z')
-        with py7zr.SevenZipFile(translate_archive_path, 'w') as archive:
-            archive.writeall(output_translate_dir, "")
-        translates.append(translate_archive_path)
+        translates.append(self.archiver.submit(output_dir, '翻译打包', [(output_translate_dir, "")]).result())
         yield translates, '结束'
 
-    def transcribe_then_translate(self, files, formats):
+    def transcribe_then_translate(self, files, formats, profile: bool = False):
+        yield from self._profiled('transcribe_then_translate', self._transcribe_then_translate_job(files, formats), profile)
+
+    def _transcribe_then_translate_job(self, files, formats):
         if not files or len(files) == 0:
             return [], [], ''
         dicts.reload()
@@ -200,54 +373,55 @@ class App:
         output_translate_dir = os.path.join(output_dir, 'translate')
         os.makedirs(output_transcribe_dir, 0o755, exist_ok=True)
         os.makedirs(output_translate_dir, 0o755, exist_ok=True)
-        transcribes = []
-        ss = []
-        translates = []
-        i = 0
-        for progress in self._transcribe_whisperx(files):
-            if progress.data is None:
-                yield transcribes, translates, progress.desc
-                continue
-            ss.append(progress.data)
-            curr_transcribes = subs.write_all(
-                subs.Sub(event.clean_ja() for event in progress.data), output_transcribe_dir, os.path.splitext(os.path.basename(files[i].name))[0], formats,
-            )
-            transcribes.extend(curr_transcribes)
-            i += 1
-            yield transcribes, translates, progress.desc
-        # archive
-        transcribe_archive_path = os.path.join(output_dir, '转录打包.7z')
-        with py7zr.SevenZipFile(transcribe_archive_path, 'w') as archive:
-            archive.writeall(output_transcribe_dir, "")
-        transcribes.append(transcribe_archive_path)
-        yield transcribes, translates, '转录结束, 等待启动翻译'
-        # wait 5s
-        time.sleep(5)
-        gc.collect()
-        torch.cuda.empty_cache()
-        # translate
-        i = 0
-        for progress in self._translate(ss):
-            if progress.data is None:
-                yield transcribes, translates, progress.desc
-                continue
-            sub = progress.data
-            curr_transcribes = subs.write_all(
-                sub, output_translate_dir, os.path.splitext(os.path.basename(files[i].name))[0], formats,
-            )
-            translates.extend(curr_transcribes)
-            i += 1
-            yield transcribes, translates, progress.desc
-        # archive
-        translate_archive_path = os.path.join(output_dir, '翻译打包.7z')
-        with py7zr.SevenZipFile(translate_archive_path, 'w') as archive:
-            archive.writeall(output_translate_dir, "")
-        translates.append(translate_archive_path)
-        all_archive_path = os.path.join(output_dir, '全部打包.7z')
-        with py7zr.SevenZipFile(all_archive_path, 'w') as archive:
-            archive.writeall(output_transcribe_dir, "转录")
-            archive.writeall(output_translate_dir, "翻译")
-        translates.append(all_archive_path)
+        transcribes = output.PendingFiles()
+        # 转录结果暂存到磁盘, 翻译时逐个读回, 不在内存里保留所有文件
+        ss = output.Spill(os.path.join(output_dir, '.spill'))
+        translates = output.PendingFiles()
+        # 任务出错或者被取消时也要删掉暂存的转录结果
+        try:
+            i = 0
+            for progress in self._transcribe_whisperx(files):
+                if progress.data is None:
+                    yield gr.update(), gr.update(), progress.desc
+                    continue
+                ss.put(progress.data)
+                transcribes.add(self.writer.write_sub(
+                    subs.Sub(event.clean_ja() for event in progress.data), output_transcribe_dir, os.path.splitext(os.path.basename(files[i].name))[0], formats,
+                ))
+                i += 1
+                yield transcribes.ready(), gr.update(), progress.desc
+            self.writer.flush()
+            transcribes = transcribes.wait()
+            # archive, 在后台打包, 和翻译并行
+            transcribe_archive = self.archiver.submit(output_dir, '转录打包', [(output_transcribe_dir, "")])
+            yield transcribes, translates.ready(), '转录结束, 等待启动翻译'
+            # wait 5s
+            time.sleep(5)
+            gc.collect()
+            torch.cuda.empty_cache()
+            # translate
+            for progress in self._translate(iter(ss), len(ss)):
+                if progress.data is None:
+                    yield gr.update(), gr.update(), progress.desc
+                    continue
+                sub = progress.data
+                translates.add(self.writer.write_sub(
+                    sub, output_translate_dir, os.path.splitext(os.path.basename(files[progress.index].name))[0], formats,
+                ))
+                yield gr.update(), translates.ready(), progress.desc
+        finally:
+            ss.cleanup()
+        self.writer.flush()
+        translates = translates.wait()
+        # archive, 翻译打包和全部打包并行
+        translate_archive = self.archiver.submit(output_dir, '翻译打包', [(output_translate_dir, "")])
+        all_archive = self.archiver.submit(output_dir, '全部打包', [
+            (output_transcribe_dir, "转录"),
+            (output_translate_dir, "翻译"),
+        ])
+        transcribes.append(transcribe_archive.result())
+        translates.append(translate_archive.result())
+        translates.append(all_archive.result())
         yield transcribes, translates, '结束'
 
     def launch(self):
@@ -261,6 +435,7 @@ class App:
                         with gr.Column():
                             output_formats = gr.Dropdown(label="输出文件格式", choices=['lrc', 'vtt', 'txt'],
                                                          value=['lrc', 'vtt'], multiselect=True)
+                            profile = gr.Checkbox(label="性能分析", value=self.profile)
                     with gr.Row():
                         btn_run = gr.Button("点击运行", variant="primary")
                         btn_clear = gr.Button("清空")
@@ -270,7 +445,7 @@ class App:
                         transcribe_files = gr.Files(label="转录结果", interactive=False)
                         translate_files = gr.Files(label="翻译结果", interactive=False)
                     btn_run.click(self.transcribe_then_translate,
-                                  inputs=[input_files, output_formats],
+                                  inputs=[input_files, output_formats, profile],
                                   outputs=[transcribe_files, translate_files, progress],
                                   concurrency_id=self.concurrent_id)
                     btn_clear.click(lambda: ([], ['lrc'], [], [], ''), outputs=[input_files, output_formats, transcribe_files, translate_files, progress])
@@ -281,6 +456,7 @@ class App:
                         output_formats = gr.Dropdown(label="输出文件格式",
                                                      choices=['lrc', 'vtt', 'txt'], value=['lrc', 'vtt'],
                                                      multiselect=True)
+                        profile = gr.Checkbox(label="性能分析", value=self.profile)
                     with gr.Row():
                         btn_run = gr.Button("点击运行", variant="primary")
                         btn_clear = gr.Button("清空")
@@ -288,7 +464,7 @@ class App:
                         progress = gr.Text(label="进度")
                     with gr.Row():
                         transcribe_files = gr.Files(label="转录结果", interactive=False)
-                    btn_run.click(self.transcribe, inputs=[input_files, output_formats], outputs=[transcribe_files, progress],
+                    btn_run.click(self.transcribe, inputs=[input_files, output_formats, profile], outputs=[transcribe_files, progress],
                                   concurrency_id=self.concurrent_id)
                     btn_clear.click(lambda: ([], ['lrc'], [], ''), outputs=[input_files, output_formats, transcribe_files, progress])
                 with gr.TabItem("翻译(sakura)"):
@@ -299,6 +475,7 @@ class App:
                                                      choices=['lrc', 'vtt', 'txt'],
                                                      value=['lrc'],
                                                      multiselect=True)
+                        profile = gr.Checkbox(label="性能分析", value=self.profile)
                     with gr.Row():
                         btn_run = gr.Button("点击运行", variant="primary")
                         btn_clear = gr.Button("清空")
@@ -306,7 +483,7 @@ class App:
                         progress = gr.Text(label="进度")
                     with gr.Row():
                         translate_files = gr.Files(label="翻译结果", interactive=False)
-                    btn_run.click(self.translate, inputs=[input_files, output_formats], outputs=[translate_files, progress],
+                    btn_run.click(self.translate, inputs=[input_files, output_formats, profile], outputs=[translate_files, progress],
                                   concurrency_id=self.concurrent_id)
                     btn_clear.click(lambda: ([], ['lrc'], [], ''), outputs=[input_files, output_formats, translate_files, progress])
         gr_args = {
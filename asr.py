@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+
+# whisperx.load_audio 输出的采样率
+SAMPLE_RATE = 16000
+
+
+def voiced_spans(
+        audio: np.ndarray,
+        sample_rate: int = SAMPLE_RATE,
+        frame_ms: int = 30,
+        threshold_db: float = -50.0,
+        noise_margin_db: float = 12.0,
+        max_threshold_db: float = -40.0,
+        min_dynamic_range_db: float = 20.0,
+        min_silence: float = 1.5,
+        padding: float = 0.4,
+) -> np.ndarray:
+    """
+    基于短时能量找出有声音的区间, 返回 (n, 2) 的 [开始, 结束) 采样点下标
+    阈值默认为 threshold_db, 只有存在明显的低能量部分 (底噪) 时才提高到 底噪 + noise_margin_db, 环境音较大的录音也能切掉:
+    - 底噪取能量的 10% 分位, 需要比 90% 分位低 min_dynamic_range_db 以上
+    - 提高后的阈值不超过 max_threshold_db, 底噪高于 max_threshold_db - noise_margin_db 时认为 "底噪" 其实是小声说话, 不提高
+    短于 min_silence 秒的静音不切, 每段前后保留 padding 秒
+    """
+    frame = max(1, sample_rate * frame_ms // 1000)
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return np.array([[0, len(audio)]], dtype=np.int64)
+    frames = audio[:n_frames * frame].reshape(n_frames, frame).astype(np.float32)
+    rms = np.sqrt(np.mean(np.square(frames), axis=1))
+    db = 20 * np.log10(rms + 1e-10)
+    threshold = threshold_db
+    floor, loud = np.percentile(db, [10, 90])
+    if loud - floor >= min_dynamic_range_db and floor + noise_margin_db <= max_threshold_db:
+        threshold = max(threshold_db, float(floor) + noise_margin_db)
+    voiced = db > threshold
+    if not voiced.any():
+        return np.zeros((0, 2), dtype=np.int64)
+    edges = np.diff(np.concatenate(([0], voiced.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # padding
+    pad = int(round(padding * 1000 / frame_ms))
+    starts = np.maximum(starts - pad, 0)
+    ends = np.minimum(ends + pad, n_frames)
+    # 合并间隔太短的区间
+    keep = (starts[1:] - ends[:-1]) >= int(round(min_silence * 1000 / frame_ms))
+    starts = np.concatenate((starts[:1], starts[1:][keep]))
+    ends = np.concatenate((ends[:-1][keep], ends[-1:]))
+    spans = np.stack((starts, ends), axis=1) * frame
+    # 最后一段延伸到音频结尾, 不丢掉不足一帧的部分
+    if spans[-1, 1] == n_frames * frame:
+        spans[-1, 1] = len(audio)
+    return spans.astype(np.int64)
+
+
+class TimeMap:
+    """
+    去掉静音后拼接的音频 -> 原始音频 的时间映射
+    """
+
+    def __init__(self, spans: np.ndarray, sample_rate: int = SAMPLE_RATE):
+        spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+        lengths = spans[:, 1] - spans[:, 0]
+        self.original_starts = spans[:, 0] / sample_rate
+        self.trimmed_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) / sample_rate
+        self.voiced_seconds = float(lengths.sum()) / sample_rate
+
+    def map(self, t, is_end: bool = False):
+        """
+        拼接处的时间, 作为开始时间时映射到后一段的开头, 作为结束时间时映射到前一段的结尾
+        """
+        t = np.asarray(t, dtype=np.float64)
+        if len(self.trimmed_starts) == 0:
+            return t
+        k = np.searchsorted(self.trimmed_starts, t, side='left' if is_end else 'right') - 1
+        k = np.clip(k, 0, len(self.trimmed_starts) - 1)
+        return self.original_starts[k] + (t - self.trimmed_starts[k])
+
+    def remap(self, whisper_result):
+        """
+        原地修改 whisperx 结果中所有段和逐字的时间
+        """
+        for key, is_end in (("start", False), ("end", True)):
+            items = []
+            for seg in whisper_result["segments"]:
+                items.append(seg)
+                items.extend(seg.get("words") or [])
+            items = [item for item in items if item.get(key) is not None]
+            if len(items) == 0:
+                continue
+            mapped = self.map([item[key] for item in items], is_end=is_end)
+            for item, value in zip(items, mapped.tolist()):
+                item[key] = value
+        return whisper_result
+
+
+def trim_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, **kwargs) -> (np.ndarray, TimeMap):
+    """
+    返回去掉静音后的音频和时间映射, 整段都是静音时返回原音频
+    """
+    spans = voiced_spans(audio, sample_rate, **kwargs)
+    if len(spans) == 0:
+        spans = np.array([[0, len(audio)]], dtype=np.int64)
+    trimmed = np.concatenate([audio[start:end] for start, end in spans])
+    return trimmed, TimeMap(spans, sample_rate)
+
+
+# 每个 batch 元素 (30s 音频) 大约需要的内存, 按模型大小粗略估计, 单位 GiB
+BATCH_ITEM_MEMORY = {
+    "large": 1.0,
+    "medium": 0.6,
+    "small": 0.3,
+    "base": 0.15,
+    "tiny": 0.1,
+}
+MAX_BATCH_SIZE = 16
+
+
+def available_memory(device: str) -> int:
+    """
+    当前可用内存, 单位字节, cuda 为显存
+    """
+    if device == "cuda":
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def pick_batch_size(device: str, model_name: str, free_bytes: int = None) -> int:
+    """
+    按可用内存估计 batch_size, 取 2 的幂, 范围 [1, MAX_BATCH_SIZE]
+    """
+    if free_bytes is None:
+        free_bytes = available_memory(device)
+    per_item = BATCH_ITEM_MEMORY["large"]
+    for name, size in BATCH_ITEM_MEMORY.items():
+        if name in os.path.basename(str(model_name)).lower():
+            per_item = size
+            break
+    # 留 20% 余量
+    n = int(free_bytes * 0.8 / (per_item * (1 << 30)))
+    batch_size = 1
+    while batch_size * 2 <= min(n, MAX_BATCH_SIZE):
+        batch_size *= 2
+    return batch_size
+
+
+def pick_compute_type(device: str) -> str:
+    """
+    cuda 使用 float16, cpu 优先 int8, 不支持时使用 float32 (whisperx 默认的 float16 在 cpu 上无法运行)
+    """
+    if device == "cuda":
+        return "float16"
+    try:
+        import ctranslate2
+        if "int8" in ctranslate2.get_supported_compute_types("cpu"):
+            return "int8"
+    except (ImportError, RuntimeError):
+        pass
+    return "float32"
+
+
+def is_oom(e: BaseException) -> bool:
+    if isinstance(e, MemoryError):
+        return True
+    return "out of memory" in str(e).lower()
@@ -0,0 +1,119 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import subs
+
+
+def fake_whisper_result(n: int, seed: int = 1) -> dict:
+    """
+    生成和 whisperx 输出结构一致的转录结果, 包含逐字时间, 少量可合并的重复段和空段
+    """
+    rng = random.Random(seed)
+    segments = []
+    t = 0.0
+    for _ in range(n):
+        words = []
+        for _ in range(rng.randint(3, 20)):
+            words.append({"word": rng.choice("あいうえおかきくけこ"), "start": t, "end": t + 0.1, "score": rng.random()})
+            t += 0.15
+        text = "".join(word["word"] for word in words)
+        segments.append({"start": words[0]["start"], "end": t, "text": text, "words": words})
+        if rng.random() < 0.1:
+            segments.append({"start": t, "end": t + 1, "text": text + "ね",
+                             "words": words + [{"word": "ね", "start": t, "end": t + 1}]})
+        if rng.random() < 0.05:
+            segments.append({"start": t, "end": t + 1, "text": "", "words": []})
+    return {"segments": segments}
+
+
+def sub_with_words(whisper_result) -> subs.Sub:
+    """
+    对照: 用 SubEvent / SubEventWord 对象保留逐字时间
+    """
+    return subs.Sub(
+        subs.SubEvent(seg["start"], seg["end"], seg["text"], [subs.SubEventWord(**word) for word in seg["words"]])
+        for seg in whisper_result["segments"]
+    )
+
+
+def measure(label: str, fn):
+    """
+    时间和内存分开测, tracemalloc 本身会让分配很多的代码慢好几倍
+    """
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:36s} {elapsed:6.2f}s  retained {current / 1e6:7.1f}MB  peak {peak / 1e6:7.1f}MB")
+    return result
+
+
+def bench_compact(n: int):
+    print(f"转录结果: {n} 段")
+    whisper_result = fake_whisper_result(n)
+    measure("Sub.from_fast_whisper (no words)", lambda: subs.Sub.from_fast_whisper(whisper_result))
+    measure("Sub with SubEventWord", lambda: sub_with_words(whisper_result))
+    measure("CompactSub.from_fast_whisper", lambda: subs.CompactSub.from_fast_whisper(whisper_result))
+
+
+def baseline_load_lrc(file) -> subs.Sub:
+    """
+    对照: 流式解析之前的 lrc 读取, 整个文件读入后排序
+    """
+    with open(file, mode='r', encoding='utf8') as f:
+        half_events = []
+        for line in f.readlines():
+            start, text = line.split("]", 1)
+            half_events.append((subs.parse_lrc_timestamp(start.lstrip("[")), text.strip()))
+    half_events.sort(key=lambda x: x[0])
+    sub = subs.Sub()
+    for i, (start, text) in enumerate(half_events):
+        if text == "":
+            continue
+        end = half_events[i + 1][0] if i + 1 < len(half_events) else start + 10
+        sub.append(subs.SubEvent(start=start, end=end, text=text))
+    return sub
+
+
+def bench_parsers(n: int):
+    print(f"字幕文件: {n} 行")
+    events = [subs.SubEvent(i * 2.0, i * 2.0 + 1.5, f"テスト行{i}です") for i in range(n)]
+    baselines = {
+        'srt': lambda path: subs.Sub.load_pysubs2(path, 'srt'),
+        'vtt': lambda path: subs.Sub.load_pysubs2(path, 'vtt'),
+        'lrc': baseline_load_lrc,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for fmt, baseline in baselines.items():
+            path = subs.write_all(subs.Sub(events), directory, 'bench', [fmt])[0]
+            measure(f"{fmt} baseline", lambda: baseline(path))
+            measure(f"{fmt} Sub.load_file", lambda: subs.Sub.load_file(path))
+            out = os.path.join(directory, f'out.{fmt}')
+            writer = {'srt': subs.write_srt, 'vtt': subs.write_vtt, 'lrc': subs.write_lrc}[fmt]
+
+            def convert():
+                with open(out, 'w', encoding='utf-8') as f:
+                    writer(subs.iter_file(path), f)
+
+            measure(f"{fmt} stream read+write", convert)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--segments', type=int, default=60000)
+    parser.add_argument('--events', type=int, default=100000)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    bench_compact(args.segments)
+    print()
+    bench_parsers(args.events)
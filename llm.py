@@ -1,21 +1,56 @@
 import dataclasses
+import hashlib
+import inspect
+import json
+import os
 import pathlib
+import platform
+import time
+import traceback
 from dataclasses import dataclass
 
 from llm_types import *
 
 
+# llama-cpp-python create_completion 的默认值, SakuraGenerationConfig 中为 None 的参数在批量解码时按这些值处理
+LLAMA_CPP_SAMPLING_DEFAULTS = {
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "min_p": 0.05,
+    "top_k": 40,
+    "repeat_penalty": 1.0,
+    "frequency_penalty": 0.0,
+    "presence_penalty": 0.0,
+}
+# Llama 的 last_n_tokens_size 默认值, 重复惩罚只看最近的这些 token (包括 prompt)
+PENALTY_LAST_N = 64
+
+
 @dataclass
 class SakuraConfig:
     model_name_or_path: str
 
     use_gpu: bool = True
     text_length: int = 1024
+    # 同时翻译的文件数, 每个文件占用 4*text_length 的 kv cache
+    n_parallel: int = 1
 
     model_name: str = None
     model_version: str = None
     model_quant: str = None
 
+    # 是否加载 llm_tune.py 调优后保存的 llama.cpp 参数
+    use_tuned: bool = True
+    # 直接传给 llama_cpp.Llama 的参数, 优先级高于调优结果
+    llama_config: dict = None
+
+    # 投机解码, None: 不启用, prompt_lookup: 从 prompt 中查找候选 (不需要额外模型), draft: 使用小模型起草
+    # temperature 为 0 时输出和不启用完全一致
+    speculative: Literal["prompt_lookup", "draft"] = None
+    # draft 模式使用的小模型, 需要和主模型使用相同的词表
+    draft_model_name_or_path: str = None
+    draft_num_pred_tokens: int = 10
+
 
 @dataclass
 class SakuraGenerationConfig:
@@ -44,6 +79,31 @@ class SakuraGenerationConfig:
         return self.llama_cpp()
 
 
+@dataclass
+class SpeculativeStats:
+    proposed: int = 0
+    accepted: int = 0
+    completion_tokens: int = 0
+    seconds: float = 0.0
+
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed > 0 else 0.0
+
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.seconds if self.seconds > 0 else 0.0
+
+    def since(self, start: 'SpeculativeStats') -> 'SpeculativeStats':
+        """
+        start 为之前用 dataclasses.replace 保存的快照, 返回这之后的增量
+        """
+        return SpeculativeStats(
+            proposed=self.proposed - start.proposed,
+            accepted=self.accepted - start.accepted,
+            completion_tokens=self.completion_tokens - start.completion_tokens,
+            seconds=self.seconds - start.seconds,
+        )
+
+
 @dataclass
 class SakuraCompletionResponse:
     text: str
@@ -65,6 +125,7 @@ class Sakura:
         if cfg.model_quant is None:
             cfg.model_quant = model_quant
         self.cfg = cfg
+        self.speculative_stats = SpeculativeStats()
         # load model
         self._load_model(cfg)
 
@@ -74,7 +135,7 @@ class Sakura:
     def _load_llama_cpp(self, cfg: SakuraConfig):
         import llama_cpp
         llama_config = {
-            "n_ctx": 4*cfg.text_length,
+            "n_ctx": 4*cfg.text_length*max(1, cfg.n_parallel),
         }
         if cfg.use_gpu:
             llama_config["n_gpu_layers"] = -1
@@ -82,13 +143,270 @@ class Sakura:
         else:
             llama_config["n_gpu_layers"] = 0
             llama_config["offload_kqv"] = False
+        if cfg.use_tuned:
+            tuned = load_tuned_config(cfg.model_name_or_path, cfg.use_gpu)
+            if tuned:
+                print(f"使用调优后的 llama.cpp 参数: {tuned}")
+                llama_config.update(tuned)
+        if cfg.llama_config:
+            llama_config.update(cfg.llama_config)
+        self._draft_model = None
+        if cfg.speculative is not None:
+            self._draft_model = TrackedDraftModel(self._load_draft_model(cfg, llama_config), self.speculative_stats)
+            llama_config["draft_model"] = self._draft_model
+        # 批量解码时每个文件是一个序列, llama.cpp 要求 seq_id < n_seq_max
+        n_seq_max = max(1, cfg.n_parallel)
+        pass_n_seq_max = n_seq_max > 1 and "n_seq_max" in inspect.signature(llama_cpp.Llama.__init__).parameters
+        if pass_n_seq_max:
+            llama_config["n_seq_max"] = n_seq_max
         self._model = llama_cpp.Llama(
             cfg.model_name_or_path,
             **llama_config,
         )
         self._tokenizer = llama_cpp.LlamaTokenizer(self._model)
+        self._batch_failed = False
+        self._n_seq_max = 1
+        if n_seq_max > 1:
+            try:
+                if not pass_n_seq_max:
+                    self._recreate_context(n_seq_max)
+                self._n_seq_max = self._model.context_params.n_seq_max
+            except Exception as e:
+                self._disable_batch(f"无法创建支持 {n_seq_max} 个序列的 context: {e!r}")
+
+    def _recreate_context(self, n_seq_max: int):
+        """
+        llama-cpp-python 的 Llama 不接受 n_seq_max 参数, 按新的 context_params 重新创建 context
+        """
+        from llama_cpp import _internals
+        model = self._model
+        if model.context_params.n_seq_max >= n_seq_max:
+            return
+        # 0.2.x 中类名为 _LlamaContext
+        context_class = getattr(_internals, "LlamaContext", None) or _internals._LlamaContext
+        model.context_params.n_seq_max = n_seq_max
+        if hasattr(model._ctx, "close"):
+            model._ctx.close()
+        model._ctx = context_class(model=model._model, params=model.context_params, verbose=model.verbose)
+        if hasattr(model, "_stack"):
+            model._stack.callback(model._ctx.close)
+
+    def _disable_batch(self, reason: str):
+        self._batch_failed = True
+        print(f"warning, 批量解码已停用, 之后的请求逐个调用, --n_parallel 不再生效: {reason}")
+
+    @staticmethod
+    def _load_draft_model(cfg: SakuraConfig, llama_config: dict):
+        match cfg.speculative:
+            case "prompt_lookup":
+                from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+                return LlamaPromptLookupDecoding(num_pred_tokens=cfg.draft_num_pred_tokens)
+            case "draft":
+                if not cfg.draft_model_name_or_path:
+                    raise ValueError("draft_model_name_or_path is required for speculative=draft")
+                return SmallDraftModel(
+                    cfg.draft_model_name_or_path,
+                    n_ctx=llama_config["n_ctx"],
+                    n_gpu_layers=llama_config["n_gpu_layers"],
+                    num_pred_tokens=cfg.draft_num_pred_tokens,
+                )
+            case _:
+                raise ValueError(f"Unsupported speculative mode: {cfg.speculative}")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._model.tokenize(text.encode('utf-8'), add_bos=False))
+
+    def max_sequences(self) -> int:
+        """
+        kv cache 能同时容纳的序列数
+        """
+        if self._batch_failed:
+            return 1
+        return max(1, min(self._n_seq_max, self._model.n_ctx() // (4*self.cfg.text_length)))
+
+    def completion_batch(self, prompts: [str], cfg: SakuraGenerationConfig, keys: list = None) -> [SakuraCompletionResponse]:
+        """
+        多个 prompt 作为不同的序列放进同一个 context, 每步一起解码
+        按 kv cache 剩余空间分批, 批量解码失败时回退到逐个调用 completion
+        keys 为每个 prompt 所属的文件, 只有 llm_router.Router 使用
+        """
+        if len(prompts) <= 1 or self._batch_failed or self.cfg.speculative is not None:
+            return [self.completion(prompt, dataclasses.replace(cfg)) for prompt in prompts]
+        cfg = dataclasses.replace(cfg)
+        cfg.load_sakura_config(self.cfg)
+        tokens = [self._model.tokenize(prompt.encode('utf-8'), add_bos=True, special=True) for prompt in prompts]
+        results: [Optional[SakuraCompletionResponse]] = [None] * len(prompts)
+        n_ctx = self._model.n_ctx()
+        i = 0
+        while i < len(prompts):
+            # 按 kv cache 容量打包, 每个序列按 prompt + max_new_tokens 预留
+            group, used = [], 0
+            while i < len(prompts):
+                need = len(tokens[i]) + cfg.max_new_tokens
+                if len(group) > 0 and used + need > n_ctx:
+                    break
+                group.append(i)
+                used += need
+                i += 1
+            if len(group) == 1:
+                results[group[0]] = self.completion(prompts[group[0]], dataclasses.replace(cfg))
+                continue
+            try:
+                for idx, result in zip(group, self._decode_batch([tokens[idx] for idx in group], cfg)):
+                    results[idx] = result
+            except Exception as e:
+                traceback.print_exc()
+                self._disable_batch(f"批量解码失败: {e!r}")
+                for idx in group:
+                    results[idx] = self.completion(prompts[idx], dataclasses.replace(cfg))
+        return results
+
+    def _decode_batch(self, prompts_tokens: [[int]], cfg: SakuraGenerationConfig) -> [SakuraCompletionResponse]:
+        import llama_cpp
+        import numpy as np
+        model = self._model
+        ctx = model.ctx
+        n_vocab = model.n_vocab()
+        n_batch = model.n_batch
+        rng = np.random.default_rng(cfg.seed)
+        n_seq = len(prompts_tokens)
+        batch = llama_cpp.llama_batch_init(max(n_batch, n_seq), 0, n_seq)
+        # 批量解码会覆盖 Llama 自己记录的 kv cache 状态, 用完之后清空
+        llama_cpp.llama_kv_cache_clear(ctx)
+        model.n_tokens = 0
+        try:
+            # prompt 阶段, 所有序列的 token 拼在一起按 n_batch 分块解码, 只取每个序列最后一个 token 的 logits
+            logits = [None] * n_seq
+            n_past = [len(tokens) for tokens in prompts_tokens]
+            pending = [(seq, pos, token) for seq, tokens in enumerate(prompts_tokens) for pos, token in enumerate(tokens)]
+            for start in range(0, len(pending), n_batch):
+                chunk = pending[start:start + n_batch]
+                batch.n_tokens = len(chunk)
+                last = []
+                for k, (seq, pos, token) in enumerate(chunk):
+                    batch.token[k] = token
+                    batch.pos[k] = pos
+                    batch.n_seq_id[k] = 1
+                    batch.seq_id[k][0] = seq
+                    batch.logits[k] = pos == n_past[seq] - 1
+                    if pos == n_past[seq] - 1:
+                        last.append((seq, k))
+                self._llama_decode(ctx, batch)
+                for seq, k in last:
+                    logits[seq] = np.ctypeslib.as_array(
+                        llama_cpp.llama_get_logits_ith(ctx, k), shape=(n_vocab,)
+                    ).copy()
+            generated: [[int]] = [[] for _ in range(n_seq)]
+            finish_reason: [Optional[str]] = [None] * n_seq
+            while True:
+                active = []
+                for seq in range(n_seq):
+                    if finish_reason[seq] is not None:
+                        continue
+                    recent = prompts_tokens[seq][-PENALTY_LAST_N:] + generated[seq][-PENALTY_LAST_N:]
+                    token = self._sample(logits[seq], recent, cfg, rng)
+                    if llama_cpp.llama_token_is_eog(model.model, token):
+                        finish_reason[seq] = "stop"
+                        continue
+                    generated[seq].append(token)
+                    if len(generated[seq]) >= cfg.max_new_tokens:
+                        finish_reason[seq] = "length"
+                        continue
+                    active.append((seq, token))
+                if len(active) == 0:
+                    break
+                batch.n_tokens = len(active)
+                for k, (seq, token) in enumerate(active):
+                    batch.token[k] = token
+                    batch.pos[k] = n_past[seq]
+                    batch.n_seq_id[k] = 1
+                    batch.seq_id[k][0] = seq
+                    batch.logits[k] = True
+                    n_past[seq] += 1
+                self._llama_decode(ctx, batch)
+                for k, (seq, _) in enumerate(active):
+                    logits[seq] = np.ctypeslib.as_array(
+                        llama_cpp.llama_get_logits_ith(ctx, k), shape=(n_vocab,)
+                    ).copy()
+        finally:
+            llama_cpp.llama_kv_cache_clear(ctx)
+            llama_cpp.llama_batch_free(batch)
+        results = []
+        for seq in range(n_seq):
+            text = model.detokenize(generated[seq]).decode('utf-8', errors='ignore')
+            prompt_tokens = len(prompts_tokens[seq])
+            completion_tokens = len(generated[seq])
+            results.append(SakuraCompletionResponse(
+                text=text,
+                finish_reason=finish_reason[seq],
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ))
+        return results
+
+    @staticmethod
+    def _llama_decode(ctx, batch):
+        import llama_cpp
+        ret = llama_cpp.llama_decode(ctx, batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode returned {ret}")
+
+    @staticmethod
+    def _sample(logits, tokens: [int], cfg: SakuraGenerationConfig, rng) -> int:
+        """
+        批量解码时的采样, 按 llama-cpp-python 的采样链实现: 惩罚 -> top_k -> top_p -> min_p -> temperature
+        tokens 为 prompt + 已生成的 token, 只有最后 PENALTY_LAST_N 个参与惩罚
+        temperature <= 0 或 top_k == 1 时为贪心解码, 和逐个调用的结果一致 (只可能有浮点误差)
+        否则分布相同, 但随机数和 llama.cpp 不同, 同一个 seed 得到的译文也可能不同
+        """
+        import numpy as np
+        params = {
+            k: getattr(cfg, k) if getattr(cfg, k) is not None else v
+            for k, v in LLAMA_CPP_SAMPLING_DEFAULTS.items()
+        }
+        logits = logits.astype(np.float64)
+        recent = tokens[-PENALTY_LAST_N:]
+        if len(recent) > 0:
+            ids, counts = np.unique(np.asarray(recent), return_counts=True)
+            if params["repeat_penalty"] != 1.0:
+                logits[ids] = np.where(
+                    logits[ids] > 0, logits[ids] / params["repeat_penalty"], logits[ids] * params["repeat_penalty"],
+                )
+            logits[ids] -= counts * params["frequency_penalty"] + params["presence_penalty"]
+        if params["temperature"] <= 0 or params["top_k"] == 1:
+            return int(np.argmax(logits))
+        top_k = params["top_k"] if 0 < params["top_k"] < len(logits) else len(logits)
+        candidates = np.argpartition(-logits, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-logits[candidates])]
+        # top_p / min_p 在 temperature 之前, 按原始分布筛选
+        probs = np.exp(logits[candidates] - logits[candidates[0]])
+        probs /= probs.sum()
+        if params["top_p"] < 1.0:
+            keep = np.cumsum(probs) - probs < params["top_p"]
+            candidates, probs = candidates[keep], probs[keep]
+        if params["min_p"] > 0:
+            keep = probs >= params["min_p"] * probs[0]
+            candidates = candidates[keep]
+        probs = np.exp((logits[candidates] - logits[candidates[0]]) / params["temperature"])
+        probs /= probs.sum()
+        return int(rng.choice(candidates, p=probs))
+
+    def release(self, key):
+        """
+        和 llm_router.Router 保持一致, 单个实例不需要处理
+        """
 
     def completion(self, prompt: str, cfg: SakuraGenerationConfig) -> SakuraCompletionResponse:
+        if self._draft_model is not None:
+            self._draft_model.reset()
+        start = time.perf_counter()
+        ret = self._completion(prompt, cfg)
+        self.speculative_stats.seconds += time.perf_counter() - start
+        self.speculative_stats.completion_tokens += ret.completion_tokens
+        return ret
+
+    def _completion(self, prompt: str, cfg: SakuraGenerationConfig) -> SakuraCompletionResponse:
         cfg.load_sakura_config(self.cfg)
         cfg.stream = False
         resp: Optional[CreateCompletionResponse] = None
@@ -121,3 +439,124 @@ class Sakura:
             ret.total_tokens = resp["usage"]["total_tokens"]
         return ret
 
+
+class TrackedDraftModel:
+    """
+    包装 llama.cpp 的 draft model, 统计候选 token 的接受率
+    llama.cpp 不直接暴露接受数量, 下一次调用时传入的 input_ids 包含了上一轮被接受的候选, 对比即可得到
+    """
+
+    def __init__(self, draft_model, stats: SpeculativeStats):
+        self._draft_model = draft_model
+        self._stats = stats
+        self._last_length = 0
+        self._last_proposal = None
+
+    def reset(self):
+        self._last_length = 0
+        self._last_proposal = None
+
+    def __call__(self, input_ids, /, **kwargs):
+        if self._last_proposal is not None and len(input_ids) > self._last_length:
+            accepted = 0
+            for actual, proposed in zip(input_ids[self._last_length:], self._last_proposal):
+                if actual != proposed:
+                    break
+                accepted += 1
+            self._stats.proposed += len(self._last_proposal)
+            self._stats.accepted += accepted
+        proposal = self._draft_model(input_ids, **kwargs)
+        self._last_length = len(input_ids)
+        self._last_proposal = proposal.copy() if len(proposal) > 0 else None
+        return proposal
+
+
+class SmallDraftModel:
+    """
+    使用一个小模型贪心生成候选 token, 接口同 llama_cpp.llama_speculative.LlamaDraftModel
+    Llama.generate 会复用和上次相同前缀的 kv cache, 每次只需要计算新增的 token
+    """
+
+    def __init__(self, model_name_or_path: str, n_ctx: int, n_gpu_layers: int, num_pred_tokens: int):
+        import llama_cpp
+        self._model = llama_cpp.Llama(
+            model_name_or_path,
+            n_ctx=n_ctx,
+            n_gpu_layers=n_gpu_layers,
+            verbose=False,
+        )
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        import numpy as np
+        draft = []
+        eos = self._model.token_eos()
+        for token in self._model.generate(input_ids.tolist(), top_k=1, temp=0.0, reset=True):
+            if token == eos:
+                break
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+
+def hardware_fingerprint(use_gpu: bool) -> str:
+    """
+    调优结果和机器绑定, CPU 型号/核数/内存/GPU 任意一项变化都需要重新调优
+    """
+    cpu_model = platform.processor()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    memory = 0
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        pass
+    gpu = "cpu"
+    if use_gpu:
+        try:
+            import torch
+            if torch.cuda.is_available():
+                gpu = torch.cuda.get_device_name(0)
+        except ImportError:
+            pass
+    raw = f"{platform.machine()}|{cpu_model}|{os.cpu_count()}|{memory // (1 << 30)}G|{gpu}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def tuned_config_path(model_name_or_path: str) -> str:
+    return f"{model_name_or_path}.tune.json"
+
+
+def load_tuned_config(model_name_or_path: str, use_gpu: bool) -> Optional[dict]:
+    try:
+        with open(tuned_config_path(model_name_or_path), encoding="utf-8") as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        return None
+    entry = tuned.get(hardware_fingerprint(use_gpu))
+    if entry is None:
+        return None
+    return entry["llama_config"]
+
+
+def save_tuned_config(model_name_or_path: str, use_gpu: bool, llama_config: dict, stats: dict):
+    path = tuned_config_path(model_name_or_path)
+    tuned = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        pass
+    tuned[hardware_fingerprint(use_gpu)] = {
+        "llama_config": llama_config,
+        "stats": stats,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tuned, f, ensure_ascii=False, indent=2)
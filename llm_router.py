@@ -0,0 +1,396 @@
+import argparse
+import dataclasses
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+import llm
+
+# worker 进程 / 远程 worker 允许调用的 Sakura 方法
+WORKER_METHODS = ('completion', 'completion_batch', 'count_tokens', 'max_sequences')
+
+
+class WorkerError(Exception):
+    """
+    worker 崩溃或连接断开, 请求可以换一个 worker 重试
+    """
+
+
+def _serve_connection(model: llm.Sakura, conn, lock: threading.Lock):
+    """
+    处理一个连接上的请求, 请求为 (方法名, 参数), 返回 ("ok", 结果, 投机解码统计) 或 ("error", 异常)
+    """
+    while True:
+        try:
+            method, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        if method not in WORKER_METHODS:
+            conn.send(("error", ValueError(f"Unsupported worker method: {method}")))
+            continue
+        try:
+            with lock:
+                result = getattr(model, method)(*args)
+                stats = dataclasses.replace(model.speculative_stats)
+            conn.send(("ok", result, stats))
+        except Exception as e:
+            conn.send(("error", e))
+
+
+def _worker_main(cfg: llm.SakuraConfig, conn):
+    try:
+        model = llm.Sakura(cfg)
+    except Exception as e:
+        conn.send(("error", e))
+        return
+    conn.send(("ok", model.cfg, None))
+    _serve_connection(model, conn, threading.Lock())
+
+
+def serve(cfg: llm.SakuraConfig, address: (str, int), authkey: bytes):
+    """
+    远程 worker, 加载模型后监听 address, 每个连接一个线程, 模型调用串行执行
+    """
+    model = llm.Sakura(cfg)
+    lock = threading.Lock()
+    with Listener(address, authkey=authkey) as listener:
+        print(f"Sakura worker 已启动: {address[0]}:{address[1]}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # 认证失败等, 不影响其他连接
+                print(e)
+                continue
+            # 连接建立后先发送模型配置, 和本地 worker 的握手一致
+            conn.send(("ok", model.cfg, None))
+            threading.Thread(target=_serve_connection, args=(model, conn, lock), daemon=True).start()
+
+
+class Worker:
+    """
+    一个 Sakura 实例的客户端, 子类负责建立连接
+    同一个连接上的请求串行发送
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.cfg: llm.SakuraConfig = None
+        self.speculative_stats = llm.SpeculativeStats()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._max_sequences = None
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def start(self):
+        """
+        建立连接并等待模型加载完成, 失败时抛出 WorkerError
+        """
+        self.close()
+        try:
+            self._conn = self._connect()
+            reply = self._conn.recv()
+        except (EOFError, OSError) as e:
+            self.close()
+            raise WorkerError(f"{self.name} 启动失败: {e}") from e
+        if reply[0] != "ok":
+            self.close()
+            raise WorkerError(f"{self.name} 启动失败: {reply[1]}")
+        self.cfg = reply[1]
+        self._max_sequences = None
+        self.max_sequences()
+
+    def alive(self) -> bool:
+        return self._conn is not None
+
+    def call(self, method: str, *args):
+        with self._lock:
+            if self._conn is None:
+                raise WorkerError(f"{self.name} 未启动")
+            try:
+                self._conn.send((method, args))
+                reply = self._conn.recv()
+            except (EOFError, OSError) as e:
+                self.close()
+                raise WorkerError(f"{self.name} 已断开: {e}") from e
+        if reply[0] != "ok":
+            raise reply[1]
+        self.speculative_stats = reply[2]
+        return reply[1]
+
+    def completion(self, prompt: str, cfg: llm.SakuraGenerationConfig) -> llm.SakuraCompletionResponse:
+        return self.call('completion', prompt, cfg)
+
+    def completion_batch(self, prompts: [str], cfg: llm.SakuraGenerationConfig) -> [llm.SakuraCompletionResponse]:
+        return self.call('completion_batch', prompts, cfg)
+
+    def count_tokens(self, text: str) -> int:
+        return self.call('count_tokens', text)
+
+    def max_sequences(self) -> int:
+        if self._max_sequences is None:
+            self._max_sequences = self.call('max_sequences')
+        return self._max_sequences
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+
+class LocalWorker(Worker):
+    """
+    本地子进程中的 Sakura, 子进程崩溃 (比如被 OOM killer 杀掉) 时请求会抛出 WorkerError
+    """
+
+    def __init__(self, cfg: llm.SakuraConfig, name: str = 'local'):
+        super().__init__(name)
+        self._cfg = cfg
+        self._process = None
+
+    def _connect(self):
+        # spawn: 子进程不继承父进程的 cuda 上下文
+        ctx = multiprocessing.get_context('spawn')
+        parent, child = ctx.Pipe()
+        self._process = ctx.Process(target=_worker_main, args=(self._cfg, child), name=self.name, daemon=True)
+        self._process.start()
+        child.close()
+        return parent
+
+    def alive(self) -> bool:
+        return super().alive() and self._process is not None and self._process.is_alive()
+
+    def close(self):
+        super().close()
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+class RemoteWorker(Worker):
+    """
+    其他机器上通过 `python llm_router.py --listen` 启动的 worker
+    """
+
+    def __init__(self, address: (str, int), authkey: bytes):
+        super().__init__(f'{address[0]}:{address[1]}')
+        self.address = address
+        self.authkey = authkey
+
+    def _connect(self):
+        return Client(self.address, authkey=self.authkey)
+
+
+class Router:
+    """
+    在多个 worker 之间分配翻译请求, 接口和 llm.Sakura 一致, 可以直接传给 SakuraLLMTranslator
+    - 新文件 (key) 分配给负载最低的可用 worker, 之后同一个文件的请求都发给它
+    - worker 崩溃时标记为不可用, 请求换一个 worker 重试, 过 restart_interval 秒后在后台尝试重启
+    prompt 中已经包含历史, 换 worker 不影响翻译结果
+    """
+
+    def __init__(self, workers: [Worker], restart_interval: float = 30.0):
+        if len(workers) == 0:
+            raise ValueError("Router requires at least one worker")
+        self.workers = workers
+        self.restart_interval = restart_interval
+        self._lock = threading.Lock()
+        # key -> worker
+        self._sticky = {}
+        # worker -> 正在处理的序列数
+        self._load = {worker: 0 for worker in workers}
+        # worker -> 下次允许重启的时间
+        self._down = {}
+        self._restarting = set()
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            for worker, error in zip(workers, executor.map(self._start, workers)):
+                if error is not None:
+                    print(error)
+                    self._down[worker] = time.monotonic() + self.restart_interval
+        healthy = self._healthy()
+        if len(healthy) == 0:
+            raise RuntimeError("没有可用的 Sakura worker")
+        self.cfg: llm.SakuraConfig = healthy[0].cfg
+        self._executor = ThreadPoolExecutor(max_workers=len(workers), thread_name_prefix='llm-router')
+
+    @staticmethod
+    def _start(worker: Worker):
+        try:
+            worker.start()
+        except WorkerError as e:
+            return e
+        return None
+
+    @property
+    def speculative_stats(self) -> llm.SpeculativeStats:
+        stats = llm.SpeculativeStats()
+        for worker in self.workers:
+            for field in dataclasses.fields(stats):
+                setattr(stats, field.name, getattr(stats, field.name) + getattr(worker.speculative_stats, field.name))
+        return stats
+
+    def _healthy(self) -> [Worker]:
+        self._maybe_restart()
+        return [worker for worker in self.workers if worker not in self._down and worker.alive()]
+
+    def _maybe_restart(self):
+        now = time.monotonic()
+        for worker, retry_at in list(self._down.items()):
+            if retry_at <= now and worker not in self._restarting:
+                self._restarting.add(worker)
+                threading.Thread(target=self._restart, args=(worker,), daemon=True).start()
+
+    def _restart(self, worker: Worker):
+        error = self._start(worker)
+        with self._lock:
+            self._restarting.discard(worker)
+            if error is None:
+                print(f"{worker.name} 已重启")
+                self._down.pop(worker, None)
+            else:
+                print(error)
+                self._down[worker] = time.monotonic() + self.restart_interval
+
+    def _mark_down(self, worker: Worker, e: Exception):
+        print(f"{e}, 换一个 worker 重试")
+        with self._lock:
+            self._down[worker] = time.monotonic() + self.restart_interval
+            self._sticky = {key: w for key, w in self._sticky.items() if w is not worker}
+        worker.close()
+
+    def _pick(self, key, pending: dict = None) -> Worker:
+        """
+        pending 为这一批中已经分配但还没发出的序列数
+        """
+        with self._lock:
+            healthy = self._healthy()
+            if len(healthy) == 0:
+                raise RuntimeError("没有可用的 Sakura worker")
+            worker = self._sticky.get(key)
+            if worker is None or worker not in healthy:
+                def load(w: Worker) -> float:
+                    return (self._load[w] + (pending or {}).get(w, 0)) / w.max_sequences()
+                worker = min(healthy, key=load)
+                if key is not None:
+                    self._sticky[key] = worker
+            return worker
+
+    def _run(self, worker: Worker, n: int, fn, *args):
+        with self._lock:
+            self._load[worker] += n
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._load[worker] -= n
+
+    def count_tokens(self, text: str) -> int:
+        while True:
+            worker = self._pick(None)
+            try:
+                return worker.count_tokens(text)
+            except WorkerError as e:
+                self._mark_down(worker, e)
+
+    def max_sequences(self) -> int:
+        return max(1, sum(worker.max_sequences() for worker in self._healthy()))
+
+    def completion(self, prompt: str, cfg: llm.SakuraGenerationConfig, key=None) -> llm.SakuraCompletionResponse:
+        while True:
+            worker = self._pick(key)
+            try:
+                return self._run(worker, 1, worker.completion, prompt, cfg)
+            except WorkerError as e:
+                self._mark_down(worker, e)
+
+    def completion_batch(self, prompts: [str], cfg: llm.SakuraGenerationConfig, keys: list = None) -> [llm.SakuraCompletionResponse]:
+        """
+        按 key 把 prompt 分给各个 worker, 各 worker 并行批量解码, 崩溃的 worker 上的请求重新分配
+        """
+        if keys is None:
+            keys = [None] * len(prompts)
+        results = [None] * len(prompts)
+        remaining = list(range(len(prompts)))
+        while len(remaining) > 0:
+            groups = {}
+            for i in remaining:
+                worker = self._pick(keys[i], {w: len(g) for w, g in groups.items()})
+                groups.setdefault(worker, []).append(i)
+            futures = {
+                worker: self._executor.submit(
+                    self._run, worker, len(group), worker.completion_batch, [prompts[i] for i in group], cfg,
+                )
+                for worker, group in groups.items()
+            }
+            remaining = []
+            for worker, future in futures.items():
+                try:
+                    for i, result in zip(groups[worker], future.result()):
+                        results[i] = result
+                except WorkerError as e:
+                    self._mark_down(worker, e)
+                    remaining.extend(groups[worker])
+            remaining.sort()
+        return results
+
+    def release(self, key):
+        """
+        文件翻译结束, 之后不再需要固定 worker
+        """
+        with self._lock:
+            self._sticky.pop(key, None)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for worker in self.workers:
+            worker.close()
+
+
+def parse_address(address: str) -> (str, int):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def create(cfg: llm.SakuraConfig, local: int = 1, remote: [str] = None, authkey: str = None) -> Router:
+    """
+    local 个本地 worker 进程, 加上 remote 中 host:port 指定的远程 worker
+    """
+    workers: [Worker] = [LocalWorker(dataclasses.replace(cfg), name=f'local-{i}') for i in range(local)]
+    if remote:
+        if not authkey:
+            raise ValueError("authkey is required for remote workers")
+        workers.extend(RemoteWorker(parse_address(address), authkey.encode('utf-8')) for address in remote)
+    return Router(workers)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, required=True)
+    parser.add_argument('--use_gpu', action='store_true', default=False)
+    parser.add_argument('--text_length', type=int, default=1024)
+    parser.add_argument('--n_parallel', type=int, default=1)
+    parser.add_argument('--listen', type=str, default='0.0.0.0:20234')
+    parser.add_argument('--authkey', type=str, required=True)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    serve(
+        llm.SakuraConfig(
+            model_name_or_path=args.model_name_or_path,
+            use_gpu=args.use_gpu,
+            text_length=args.text_length,
+            n_parallel=args.n_parallel,
+        ),
+        parse_address(args.listen),
+        args.authkey.encode('utf-8'),
+    )
@@ -0,0 +1,198 @@
+import argparse
+import dataclasses
+import gc
+import os
+import time
+
+import llm
+from translate import SakuraLLMTranslator
+
+# 固定的测试文本, 长度和内容接近实际的转录结果
+SAMPLES = [
+    "今日は一日お疲れさまでした\nゆっくり休んでくださいね\nお耳、お掃除していきますよ",
+    "ふふ、くすぐったいですか？\nじっとしててくださいね\nはい、反対側も失礼しますね",
+    "あのね、ずっと言いたかったことがあるの\n先輩のこと、前からずっと見てました\nだから、その……",
+    "よし、準備できた\nじゃあ、始めよっか\n痛かったらすぐに言ってね",
+    "おやすみなさい\nまた明日も、ここで待ってますから\n",
+]
+
+
+def candidates(use_gpu: bool, text_length: int) -> dict:
+    """
+    每个参数的候选值, 调优时逐个参数搜索 (坐标下降), 不做全组合
+    """
+    cpu_count = os.cpu_count() or 1
+    threads = sorted(set(max(1, cpu_count * k // 4) for k in (1, 2, 3, 4)))
+    n_ctx = 4 * text_length
+    axes = {
+        "n_threads": threads,
+        "n_threads_batch": threads,
+        "n_batch": [n for n in (256, 512, 1024, 2048) if n <= n_ctx],
+        "n_ubatch": [n for n in (128, 256, 512) if n <= n_ctx],
+        "use_mmap": [True, False],
+        "use_mlock": [False, True],
+        "flash_attn": [False, True],
+    }
+    if use_gpu:
+        # 全部 offload 到 GPU 时线程数影响很小, 只调 batch 和 flash attention
+        for k in ("n_threads", "n_threads_batch", "use_mmap", "use_mlock"):
+            del axes[k]
+    return axes
+
+
+def initial(axes: dict) -> dict:
+    """
+    搜索起点, 线程取中间值, 其他接近 llama.cpp 默认值
+    """
+    defaults = {
+        "n_batch": 512,
+        "n_ubatch": 512,
+        "use_mmap": True,
+        "use_mlock": False,
+        "flash_attn": False,
+    }
+    config = {}
+    for k, values in axes.items():
+        if k in defaults and defaults[k] in values:
+            config[k] = defaults[k]
+        elif k == "n_threads_batch":
+            config[k] = values[-1]
+        else:
+            config[k] = values[len(values) // 2]
+    return config
+
+
+def valid(config: dict) -> bool:
+    return config.get("n_ubatch", 0) <= config.get("n_batch", 1 << 30)
+
+
+def step(best: dict, axes: dict, axis: str, value) -> dict:
+    """
+    把 best 的 axis 换成 value, n_batch 调小时 n_ubatch 一起调小 (取不超过 n_batch 的最大候选),
+    否则起点 n_ubatch=512 时 n_batch=256 永远不合法, 不会被测试
+    """
+    config = {**best, axis: value}
+    if axis == "n_batch" and "n_ubatch" in config and config["n_ubatch"] > value:
+        smaller = [n for n in axes["n_ubatch"] if n <= value]
+        if len(smaller) > 0:
+            config["n_ubatch"] = max(smaller)
+    return config
+
+
+def benchmark(cfg: llm.SakuraConfig, gen: llm.SakuraGenerationConfig, llama_config: dict, rounds: int) -> dict:
+    cfg = dataclasses.replace(cfg, use_tuned=False, llama_config=llama_config)
+    translator = SakuraLLMTranslator(cfg, dataclasses.replace(gen))
+    try:
+        # warmup, 第一次调用包含 mmap 缺页等开销
+        translator._translate(SAMPLES[0])
+        completion_tokens = 0
+        prompt_tokens = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for text in SAMPLES:
+                resp = translator._translate(text)
+                prompt_tokens += resp.prompt_tokens
+                completion_tokens += resp.completion_tokens
+        elapsed = time.perf_counter() - start
+        acceptance_rate = translator.model.speculative_stats.acceptance_rate()
+    finally:
+        del translator
+        gc.collect()
+    return {
+        "seconds": elapsed,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": (prompt_tokens + completion_tokens) / elapsed if elapsed > 0 else 0.0,
+        "completion_tokens_per_second": completion_tokens / elapsed if elapsed > 0 else 0.0,
+        "acceptance_rate": acceptance_rate,
+    }
+
+
+def greedy_generation_config(max_new_tokens: int) -> llm.SakuraGenerationConfig:
+    return llm.SakuraGenerationConfig(
+        temperature=0.0,
+        top_k=1,
+        max_new_tokens=max_new_tokens,
+        seed=0,
+    )
+
+
+def tune(cfg: llm.SakuraConfig, rounds: int = 1, max_new_tokens: int = 128) -> (dict, dict):
+    gen = greedy_generation_config(max_new_tokens)
+    axes = candidates(cfg.use_gpu, cfg.text_length)
+    best = initial(axes)
+    measured = {}
+
+    def measure(config: dict) -> dict:
+        key = tuple(sorted(config.items()))
+        if key not in measured:
+            try:
+                measured[key] = benchmark(cfg, gen, config, rounds)
+            except Exception as e:
+                print(f"参数 {config} 测试失败: {e}")
+                measured[key] = None
+            if measured[key] is not None:
+                print(f"{measured[key]['seconds']:.2f}s, {measured[key]['tokens_per_second']:.1f} tokens/s: {config}")
+        return measured[key]
+
+    best_stats = measure(best)
+    if best_stats is None:
+        raise RuntimeError(f"初始参数 {best} 无法运行")
+    for axis, values in axes.items():
+        for value in values:
+            config = step(best, axes, axis, value)
+            if config == best or not valid(config):
+                continue
+            stats = measure(config)
+            if stats is not None and stats["seconds"] < best_stats["seconds"]:
+                best, best_stats = config, stats
+    return best, best_stats
+
+
+def compare_speculative(cfg: llm.SakuraConfig, rounds: int = 1, max_new_tokens: int = 128) -> (dict, dict):
+    """
+    使用已保存的调优参数, 分别测试不启用和启用投机解码的速度
+    """
+    gen = greedy_generation_config(max_new_tokens)
+    llama_config = llm.load_tuned_config(cfg.model_name_or_path, cfg.use_gpu) or {}
+    baseline = benchmark(dataclasses.replace(cfg, speculative=None), gen, llama_config, rounds)
+    speculative = benchmark(cfg, gen, llama_config, rounds)
+    return baseline, speculative
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name_or_path', type=str, required=True)
+    parser.add_argument('--use_gpu', action='store_true', default=False)
+    parser.add_argument('--text_length', type=int, default=1024)
+    parser.add_argument('--rounds', type=int, default=1)
+    parser.add_argument('--max_new_tokens', type=int, default=128)
+    parser.add_argument('--speculative', type=str, default=None, choices=['prompt_lookup', 'draft'],
+                        help='不调优, 只对比投机解码的速度')
+    parser.add_argument('--draft_model_name_or_path', type=str, default=None)
+    parser.add_argument('--draft_num_pred_tokens', type=int, default=10)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    sakura_config = llm.SakuraConfig(
+        model_name_or_path=args.model_name_or_path,
+        use_gpu=args.use_gpu,
+        text_length=args.text_length,
+        speculative=args.speculative,
+        draft_model_name_or_path=args.draft_model_name_or_path,
+        draft_num_pred_tokens=args.draft_num_pred_tokens,
+    )
+    if args.speculative:
+        baseline, speculative = compare_speculative(sakura_config, rounds=args.rounds, max_new_tokens=args.max_new_tokens)
+        print(f"不启用: {baseline['completion_tokens_per_second']:.1f} tokens/s")
+        print(f"{args.speculative}: {speculative['completion_tokens_per_second']:.1f} tokens/s, "
+              f"接受率 {speculative['acceptance_rate']:.1%}")
+        print(f"加速比: {baseline['seconds'] / speculative['seconds']:.2f}x")
+        exit(0)
+    llama_config, stats = tune(sakura_config, rounds=args.rounds, max_new_tokens=args.max_new_tokens)
+    llm.save_tuned_config(args.model_name_or_path, args.use_gpu, llama_config, stats)
+    print(f"最优参数: {llama_config}")
+    print(f"{stats['seconds']:.2f}s, {stats['tokens_per_second']:.1f} tokens/s")
+    print(f"已保存到 {llm.tuned_config_path(args.model_name_or_path)}")
@@ -0,0 +1,221 @@
+import collections
+import gzip
+import json
+import os
+import pickle
+import queue
+import shutil
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import py7zr
+
+import subs
+
+# 7z: 原有的 py7zr 打包
+# zip: deflate 压缩, 比 7z 快很多
+# store: 只打包不压缩, 最快
+ARCHIVE_FORMATS = ['7z', 'zip', 'store']
+
+# none: 不输出调试文件
+# json: 原始 json
+# gz: gzip 压缩的 json
+DEBUG_DUMP_FORMATS = ['none', 'json', 'gz']
+
+
+class Archiver:
+    """
+    后台打包, 每个打包任务提交到线程池, 和后续的转录/翻译或其他打包任务并行执行
+    lzma/zlib 压缩时会释放 GIL, 多个打包可以同时进行
+    """
+
+    def __init__(self, fmt: str = '7z', max_workers: int = 3):
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unsupported archive format: {fmt}")
+        self.fmt = fmt
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='archive')
+
+    def path(self, output_dir: str, name: str) -> str:
+        ext = '7z' if self.fmt == '7z' else 'zip'
+        return os.path.join(output_dir, f'{name}.{ext}')
+
+    def submit(self, output_dir: str, name: str, sources: [(str, str)]) -> Future:
+        """
+        sources 为 (目录, 包内路径) 列表, 返回的 Future 结果为打包后的文件路径
+        """
+        path = self.path(output_dir, name)
+        return self._executor.submit(self._write, path, list(sources))
+
+    def _write(self, path: str, sources: [(str, str)]) -> str:
+        match self.fmt:
+            case '7z':
+                with py7zr.SevenZipFile(path, 'w') as archive:
+                    for src_dir, arcname in sources:
+                        archive.writeall(src_dir, arcname)
+            case 'zip':
+                write_zip(path, sources, zipfile.ZIP_DEFLATED)
+            case 'store':
+                write_zip(path, sources, zipfile.ZIP_STORED)
+        return path
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def write_zip(path: str, sources: [(str, str)], compression: int):
+    with zipfile.ZipFile(path, 'w', compression=compression) as archive:
+        for src_dir, arcname in sources:
+            for root, _, files in os.walk(src_dir):
+                for file in sorted(files):
+                    filepath = os.path.join(root, file)
+                    archive.write(filepath, os.path.join(arcname, os.path.relpath(filepath, src_dir)))
+
+
+class Writer:
+    """
+    后台写文件, 避免推理线程等待磁盘 (尤其是网络存储)
+    队列有上限, 写入跟不上时提交方会阻塞, 内存不会无限增长
+    """
+
+    def __init__(self, max_pending: int = 64, debug_dump: str = 'gz'):
+        if debug_dump not in DEBUG_DUMP_FORMATS:
+            raise ValueError(f"Unsupported debug dump format: {debug_dump}")
+        self.debug_dump = debug_dump
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task, strict = self._queue.get()
+            try:
+                task()
+            except Exception as e:
+                print(e)
+                if strict:
+                    self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, task, strict: bool = True):
+        """
+        strict 为 False 时, 出错只打印, 不会在 flush 时抛出
+        """
+        self._queue.put((task, strict))
+
+    def write_sub(self, sub: subs.Sub, base_dir, filename, formats) -> Future:
+        """
+        字幕在当前线程渲染成文本 (之后 sub 可能还会被修改), 只有写盘在后台进行
+        返回的 Future 在这个字幕的所有文件写完后完成, 结果和 subs.write_all 一致
+        """
+        future = Future()
+        files = []
+        errors = []
+
+        def write(filepath, content):
+            try:
+                write_text(filepath, content)
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        def done():
+            if len(errors) > 0:
+                future.set_exception(errors[0])
+            else:
+                future.set_result(files)
+
+        for filepath, content in subs.render_all(sub, base_dir, filename, formats):
+            self.submit(lambda p=filepath, c=content: write(p, c))
+            files.append(filepath)
+        # 队列按顺序执行, 排在这个字幕的所有写入之后
+        self.submit(done, strict=False)
+        return future
+
+    def write_debug_json(self, filepath_without_ext: str, obj):
+        match self.debug_dump:
+            case 'none':
+                return
+            case 'json':
+                self.submit(lambda: write_json(f'{filepath_without_ext}.json', obj), strict=False)
+            case 'gz':
+                self.submit(lambda: write_json_gz(f'{filepath_without_ext}.json.gz', obj), strict=False)
+
+    def flush(self):
+        """
+        等待所有已提交的写入完成, 如果有写入失败则抛出第一个错误
+        """
+        self._queue.join()
+        if len(self._errors) > 0:
+            errors, self._errors = self._errors, []
+            raise errors[0]
+
+
+class PendingFiles:
+    """
+    按提交顺序收集已经写完的文件, 还在写的文件不返回, 避免 gradio 读取时文件还不存在
+    """
+
+    def __init__(self):
+        self.files = []
+        self._pending = collections.deque()
+
+    def add(self, future: Future):
+        self._pending.append(future)
+
+    def ready(self) -> [str]:
+        while len(self._pending) > 0 and self._pending[0].done():
+            self.files.extend(self._pending.popleft().result())
+        return self.files
+
+    def wait(self) -> [str]:
+        while len(self._pending) > 0:
+            self.files.extend(self._pending.popleft().result())
+        return self.files
+
+
+class Spill:
+    """
+    在两个阶段之间把数据暂存到磁盘, 按放入的顺序逐个读回, 读回后删除
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, 0o755, exist_ok=True)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, obj):
+        with open(os.path.join(self.directory, f'{self._count}.pkl'), 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._count += 1
+
+    def __iter__(self):
+        for i in range(self._count):
+            filepath = os.path.join(self.directory, f'{i}.pkl')
+            with open(filepath, 'rb') as f:
+                obj = pickle.load(f)
+            os.remove(filepath)
+            yield obj
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def write_text(filepath: str, content: str):
+    with open(filepath, "w", encoding='utf-8') as f:
+        f.write(content)
+
+
+def write_json(filepath: str, obj):
+    with open(filepath, "w", encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+
+
+def write_json_gz(filepath: str, obj):
+    with gzip.open(filepath, "wt", encoding='utf-8', compresslevel=6) as f:
+        json.dump(obj, f, ensure_ascii=False)
@@ -0,0 +1,184 @@
+import collections
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+# sample: 采样, 开销低, 输出火焰图可用的 collapsed stacks
+# cprofile: 确定性的函数级统计, 开销较大, 输出 .prof 文件 (可以用 snakeviz 等工具查看)
+PROFILE_MODES = ['sample', 'cprofile']
+
+# 除了任务所在的线程, 这些后台线程也会被采样, 栈底标记为线程名
+HELPER_THREAD_PREFIXES = ('archive', 'output-writer', 'llm-router')
+# 后台线程停在这些文件中时是在等待任务, 不计入采样
+IDLE_FILES = ('threading.py', 'queue.py', os.path.join('concurrent', 'futures', 'thread.py'))
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    在后台线程中每 interval 秒抓一次任务线程和辅助线程的调用栈, 按 collapsed stacks 格式计数
+    gradio 的生成器每一步可能在不同线程执行, 由 JobProfiler 在每次 next 前告诉它当前的线程
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.job_samples = 0
+        self.job_thread = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @contextlib.contextmanager
+    def active(self):
+        self.job_thread = threading.get_ident()
+        try:
+            yield
+        finally:
+            self.job_thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            frames = sys._current_frames()
+            job_thread = self.job_thread
+            if job_thread is not None and job_thread in frames:
+                self.job_samples += 1
+                self._record('job', frames[job_thread], False)
+            for thread in threading.enumerate():
+                if thread.name.startswith(HELPER_THREAD_PREFIXES) and thread.ident in frames:
+                    self._record(thread.name.rstrip('_0123456789'), frames[thread.ident], True)
+
+    def _record(self, root: str, frame, skip_idle: bool):
+        if skip_idle and frame.f_code.co_filename.endswith(IDLE_FILES):
+            return
+        labels = []
+        # 任务线程只保留 JobProfiler.wrap 以上的部分, 去掉 gradio / 线程池的栈帧
+        while frame is not None and frame.f_code is not JobProfiler.wrap.__code__:
+            labels.append(frame_label(frame))
+            frame = frame.f_back
+        labels.append(root)
+        self.stacks[";".join(reversed(labels))] += 1
+
+    def save(self, directory: str, top: int) -> [str]:
+        folded = os.path.join(directory, 'profile.folded')
+        with open(folded, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        table = os.path.join(directory, 'profile_top.txt')
+        with open(table, 'w', encoding='utf-8') as f:
+            f.write(self.top_table(top))
+        return [folded, table]
+
+    def top_table(self, top: int) -> str:
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in self.stacks.items():
+            labels = stack.split(";")
+            own[labels[-1]] += count
+            # 递归调用只计一次
+            for label in set(labels):
+                total[label] += count
+        samples = max(self.samples, 1)
+        lines = [
+            f"采样 {self.samples} 次 (任务执行中 {self.job_samples} 次), 间隔 {self.interval * 1000:.1f}ms, "
+            f"约 {self.samples * self.interval:.1f}s",
+        ]
+        for title, counter in (("自身耗时", own), ("累计耗时 (含子调用)", total)):
+            lines.append("")
+            lines.append(f"{title} top {top}:")
+            lines.append(f"{'占比':>8} {'秒':>8}  函数")
+            for label, count in counter.most_common(top):
+                lines.append(f"{count / samples:>8.1%} {count * self.interval:>8.2f}  {label}")
+        return "\n".join(lines) + "\n"
+
+
+class DeterministicProfiler:
+    """
+    cProfile 只统计调用 enable 的线程, 每次 next 时在当前线程打开
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    @contextlib.contextmanager
+    def active(self):
+        self._profile.enable()
+        try:
+            yield
+        finally:
+            self._profile.disable()
+
+    def save(self, directory: str, top: int) -> [str]:
+        prof = os.path.join(directory, 'profile.prof')
+        self._profile.dump_stats(prof)
+        table = os.path.join(directory, 'profile_top.txt')
+        with open(table, 'w', encoding='utf-8') as f:
+            for sort in ('tottime', 'cumulative'):
+                s = io.StringIO()
+                pstats.Stats(self._profile, stream=s).sort_stats(sort).print_stats(top)
+                f.write(s.getvalue())
+        return [prof, table]
+
+
+class JobProfiler:
+    """
+    包装一个任务的生成器, 只在生成器执行时 (每次 next 期间) 记录, 等待 gradio 消费结果的时间不计入
+    App 的各个任务和 SakuraLLMTranslator.translate 等生成器都可以直接包装
+    """
+
+    def __init__(self, mode: str = 'sample', interval: float = 0.005):
+        match mode:
+            case 'sample':
+                self.profiler = SamplingProfiler(interval)
+            case 'cprofile':
+                self.profiler = DeterministicProfiler()
+            case _:
+                raise ValueError(f"Unsupported profile mode: {mode}")
+        self.mode = mode
+        self.seconds = 0.0
+
+    def wrap(self, gen):
+        self.profiler.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                with self.profiler.active():
+                    try:
+                        item = next(gen)
+                    except StopIteration as e:
+                        return e.value
+                    finally:
+                        self.seconds += time.perf_counter() - start
+                yield item
+        finally:
+            gen.close()
+            self.profiler.stop()
+
+    def save(self, directory: str, top: int = 30) -> [str]:
+        os.makedirs(directory, 0o755, exist_ok=True)
+        return self.profiler.save(directory, top)
@@ -1,8 +1,12 @@
+import io
 import os
 import re
+import unicodedata
 import collections
-from typing import TextIO
+import collections.abc
+from typing import Iterable, Iterator, TextIO
 
+import numpy as np
 import pysubs2
 from pathvalidate import sanitize_filename
 
@@ -10,6 +14,8 @@ import dicts
 
 
 class SubEventWord:
+    __slots__ = ('start', 'end', 'word', 'score')
+
     def __init__(self, start=0.0, end=0.0, word='', score=0.0):
         self.start = start
         self.end = end
@@ -22,6 +28,8 @@ class SubEvent:
     CLEAN_JA_RE = re.compile(r"([んうあ])\1{3,}")
     CLEAN_ZH_RE = re.compile(r"([啊嗯唔咦哦])\1{2,}")
 
+    __slots__ = ('start', 'end', 'text', 'line_count', 'words')
+
     def __init__(self, start=0.0, end=0.0, text='', words: [SubEventWord] = None):
         self.start = start
         self.end = end
@@ -62,6 +70,27 @@ class SubEvent:
         return self
 
 
+# 疑问和感叹会改变译文, ? 和 ! 不去掉 (NFKC 之后全角的 ？！ 已经变成半角)
+NORMALIZE_PUNCT_RE = re.compile(r"[\s、。，,.…‥・~～〜「」『』()（）\[\]【】<>＜＞♪♡❤☆★\-]+")
+NORMALIZE_MARK_RE = re.compile(r"([!?])\1+")
+# 和 SubEvent.CLEAN_JA_RE 一样只处理假名的拖长音, 数字/字母/汉字的重复 (100, ここ) 保持原样
+NORMALIZE_ELONGATION_RE = re.compile(r"([ぁ-ゖァ-ヺー])\1{2,}")
+
+
+def normalize_text(text: str) -> str:
+    """
+    用于判断两行是否重复, NFKC 后去掉空白和标点, 3 个以上连续相同的假名/长音缩成一个
+    去掉后为空的行 (纯标点) 返回原文
+    """
+    normalized = unicodedata.normalize("NFKC", text)
+    normalized = NORMALIZE_PUNCT_RE.sub("", normalized)
+    normalized = NORMALIZE_MARK_RE.sub(r"\1", normalized)
+    normalized = NORMALIZE_ELONGATION_RE.sub(r"\1", normalized)
+    if normalized == "":
+        return text
+    return normalized
+
+
 class Sub(collections.UserList):
     def __init__(self, events: [SubEvent] = None):
         if events is None:
@@ -71,19 +100,10 @@ class Sub(collections.UserList):
     @staticmethod
     def load_file(file):
         ext = os.path.splitext(file)[1].lstrip(".").lower()
-        match ext:
-            case 'txt':
-                return Sub.load_txt(file)
-            case 'lrc':
-                return Sub.load_lrc(file)
-            case 'srt':
-                return Sub.load_pysubs2(file, ext)
-            case 'vtt':
-                return Sub.load_pysubs2(file, ext)
-            case _:
-                raise ValueError(
-                    f"Unsupported file ext: {ext}"
-                )
+        if ext == 'lrc':
+            # lrc 的行不保证按时间排序, 需要整体读入后排序
+            return Sub.load_lrc(file)
+        return Sub(iter_file(file))
 
     @staticmethod
     def load_pysubs2(file, format_: str = None):
@@ -92,33 +112,30 @@ class Sub(collections.UserList):
 
     @staticmethod
     def load_lrc(file):
-        sub = Sub()
-        with open(file, mode='r', encoding='utf8') as f:
-            lines = f.readlines()
-            half_events = []
-            for i, segment in enumerate(lines):
-                start, text = segment.split("]", 1)
-                text = text.strip()
-                start = parse_lrc_timestamp(start.lstrip("["))
-                half_events.append((start, text))
-            half_events.sort(key=lambda x: x[0])
-            for i, segment in enumerate(half_events):
-                start, text = segment
-                if text == "":
-                    continue
-                end = start + 10  # fallback
-                if i+1 < len(half_events):
-                    end = half_events[i+1][0]
-                words = []
-                # TODO: parse A2 extension
-                sub.append(SubEvent(start=start, end=end, text=text, words=words))
-        return sub
+        # 大部分 lrc 是按时间排好序的, 先直接流式解析, 发现乱序再整体排序
+        ordered = True
+
+        def check_order(half_events):
+            nonlocal ordered
+            last = 0.0
+            for half_event in half_events:
+                if half_event[0] < last:
+                    ordered = False
+                last = half_event[0]
+                yield half_event
+
+        with open(file, mode='r', encoding='utf-8-sig') as f:
+            sub = Sub(pair_lrc_lines(check_order(iter_lrc_lines(f))))
+            if ordered:
+                return sub
+            f.seek(0)
+            half_events = sorted(iter_lrc_lines(f), key=lambda x: x[0])
+        return Sub(pair_lrc_lines(half_events))
 
     @staticmethod
     def load_txt(file):
-        with open(file, mode='r', encoding='utf8') as f:
-            lines = f.readlines()
-            return Sub([SubEvent(text=line) for line in lines if len(line.strip()) > 0])
+        with open(file, mode='r', encoding='utf-8-sig') as f:
+            return Sub(iter_txt(f))
 
     @staticmethod
     def from_transformer_whisper(whisper_result):
@@ -160,6 +177,258 @@ class Sub(collections.UserList):
         return merge_sub(sub)
 
 
+class CompactSub(collections.abc.Sequence):
+    """
+    列式存储的字幕, 用于长音频的转录结果
+    时间和分数存成 numpy 数组, 文本拼成一个字符串, 通过偏移量索引
+    下标访问时才构造 SubEvent, 所以对返回的 SubEvent 的修改不会写回
+    """
+
+    def __init__(self, starts, ends, text: str, text_offsets,
+                 word_offsets=None, word_starts=None, word_ends=None, word_scores=None,
+                 word_text: str = '', word_text_offsets=None):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        self.text = text
+        self.text_offsets = np.asarray(text_offsets, dtype=np.int64)
+        n = len(self.starts)
+        if word_offsets is None:
+            word_offsets = np.zeros(n + 1, dtype=np.int64)
+        self.word_offsets = np.asarray(word_offsets, dtype=np.int64)
+        self.word_starts = np.asarray(word_starts if word_starts is not None else [], dtype=np.float64)
+        self.word_ends = np.asarray(word_ends if word_ends is not None else [], dtype=np.float64)
+        self.word_scores = np.asarray(word_scores if word_scores is not None else [], dtype=np.float32)
+        self.word_text = word_text
+        if word_text_offsets is None:
+            word_text_offsets = np.zeros(1, dtype=np.int64)
+        self.word_text_offsets = np.asarray(word_text_offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._event(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("CompactSub index out of range")
+        return self._event(idx)
+
+    def _event(self, idx: int) -> SubEvent:
+        return SubEvent(
+            start=float(self.starts[idx]),
+            end=float(self.ends[idx]),
+            text=self.event_text(idx),
+            words=self.event_words(idx),
+        )
+
+    def event_text(self, idx: int) -> str:
+        return self.text[self.text_offsets[idx]:self.text_offsets[idx + 1]]
+
+    def event_words(self, idx: int) -> [SubEventWord]:
+        words = []
+        for w in range(self.word_offsets[idx], self.word_offsets[idx + 1]):
+            words.append(SubEventWord(
+                start=float(self.word_starts[w]),
+                end=float(self.word_ends[w]),
+                word=self.word_text[self.word_text_offsets[w]:self.word_text_offsets[w + 1]],
+                score=float(self.word_scores[w]),
+            ))
+        return words
+
+    def to_sub(self) -> Sub:
+        return Sub(self)
+
+    @staticmethod
+    def from_fast_whisper(whisper_result):
+        """
+        和 Sub.from_fast_whisper 的结果一致 (包括 merge_sub), 合并后的行保留最后一段的逐字时间
+        """
+        segments = whisper_result["segments"]
+        n = len(segments)
+        starts = np.empty(n, dtype=np.float64)
+        ends = np.empty(n, dtype=np.float64)
+        texts = []
+        for idx, seg in enumerate(segments):
+            begin, end = seg["start"], seg["end"]
+            if begin is None:
+                if idx == 0:
+                    begin = 0
+                else:
+                    begin = segments[idx - 1]["end"]
+            if end is None:
+                if idx != n - 1:
+                    end = segments[idx + 1]["begin"]
+                else:
+                    end = begin + 10.0
+            starts[idx], ends[idx] = begin, end
+            texts.append(seg["text"].replace("\r\n", "\n").replace("\n", " ").strip())
+        # merge, 规则同 merge_sub
+        keep_first, keep_last = [], []
+        i = 0
+        while i < n:
+            j = i + 1
+            if texts[i] != '':
+                while j < n and texts[j].startswith(texts[j - 1]):
+                    j += 1
+            keep_first.append(i)
+            keep_last.append(j - 1)
+            i = j
+        merged_texts = [texts[i] for i in keep_last]
+        # words, 只处理合并后保留的段, 直接填进预分配的数组
+        merged_words = [segments[i].get("words") or [] for i in keep_last]
+        word_offsets = _offsets(merged_words)
+        total_words = int(word_offsets[-1])
+        word_starts = np.empty(total_words, dtype=np.float64)
+        word_ends = np.empty(total_words, dtype=np.float64)
+        word_scores = np.empty(total_words, dtype=np.float32)
+        word_texts = []
+        w = 0
+        for words in merged_words:
+            for word in words:
+                word_starts[w] = word.get("start", 0.0)
+                word_ends[w] = word.get("end", 0.0)
+                word_scores[w] = word.get("score", 0.0)
+                word_texts.append(word.get("word", ""))
+                w += 1
+        return CompactSub(
+            starts=starts[keep_first],
+            ends=ends[keep_last],
+            text=''.join(merged_texts),
+            text_offsets=_offsets(merged_texts),
+            word_offsets=word_offsets,
+            word_starts=word_starts,
+            word_ends=word_ends,
+            word_scores=word_scores,
+            word_text=''.join(word_texts),
+            word_text_offsets=_offsets(word_texts),
+        )
+
+
+def _offsets(items: list):
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in items], out=offsets[1:])
+    return offsets
+
+
+def iter_file(file) -> Iterator[SubEvent]:
+    """
+    逐条读取字幕文件, 不会把整个文件读进内存
+    lrc 文件需要按时间排好序, 乱序的 lrc 请使用 Sub.load_lrc
+    """
+    ext = os.path.splitext(file)[1].lstrip(".").lower()
+    parsers = {
+        'txt': iter_txt,
+        'lrc': iter_lrc,
+        'srt': iter_srt,
+        'vtt': iter_vtt,
+    }
+    parser = parsers.get(ext)
+    if parser is None:
+        raise ValueError(
+            f"Unsupported file ext: {ext}"
+        )
+    with open(file, mode='r', encoding='utf-8-sig') as f:
+        yield from parser(f)
+
+
+def iter_txt(f: TextIO) -> Iterator[SubEvent]:
+    for line in f:
+        if len(line.strip()) > 0:
+            yield SubEvent(text=line)
+
+
+LRC_LINE_RE = re.compile(r"^\[(?:(\d+):)?(\d+)\.(\d*)](.*)$")
+LRC_WORD_RE = re.compile(r"<(\d+(?::\d+)*\.\d*)>([^<]*)")
+
+
+def iter_lrc_lines(f: TextIO) -> Iterator[tuple[float, str, list[SubEventWord]]]:
+    """
+    逐行解析 lrc, 返回 (开始时间, 文本, 逐字时间)
+    支持 A2 扩展的逐字时间, 比如 `[00:01.00]<00:01.00>あ<00:01.50>い<00:02.00>`
+    不是时间标签开头的行 (比如 `[ti:标题]`) 会被跳过
+    """
+    for line in f:
+        m = LRC_LINE_RE.match(line.strip())
+        if m is None:
+            continue
+        minutes, seconds, fraction, text = m.groups()
+        start = int(minutes or 0)*60 + int(seconds) + (float(f"0.{fraction}") if fraction else 0.0)
+        text = text.strip()
+        words = []
+        if '<' in text:
+            tags = LRC_WORD_RE.findall(text)
+            if len(tags) > 0:
+                text = LRC_WORD_RE.sub(r"\2", text).strip()
+                for i, (word_start, word) in enumerate(tags):
+                    if word == '' and i == len(tags) - 1:
+                        # 最后一个标签只表示结束时间
+                        break
+                    word_start = parse_lrc_timestamp(word_start)
+                    word_end = parse_lrc_timestamp(tags[i+1][0]) if i+1 < len(tags) else word_start
+                    words.append(SubEventWord(start=word_start, end=word_end, word=word))
+        yield start, text, words
+
+
+def pair_lrc_lines(half_events: Iterable[tuple[float, str, list[SubEventWord]]]) -> Iterator[SubEvent]:
+    """
+    lrc 的每行只有开始时间, 结束时间取下一行的开始时间
+    """
+    pending = None
+    for start, text, words in half_events:
+        if pending is not None:
+            pending.end = start
+            yield pending
+            pending = None
+        if text == "":
+            continue
+        end = start + 10  # fallback
+        if len(words) > 0:
+            end = max(end, words[-1].end)
+        pending = SubEvent(start=start, end=end, text=text, words=words)
+    if pending is not None:
+        yield pending
+
+
+def iter_lrc(f: TextIO) -> Iterator[SubEvent]:
+    return pair_lrc_lines(iter_lrc_lines(f))
+
+
+CUE_TAG_RE = re.compile(r"<[^>]*>")
+
+
+def iter_cues(f: TextIO) -> Iterator[SubEvent]:
+    """
+    srt 和 vtt 共用, 以空行分隔的块为单位解析, 没有 `-->` 的块 (序号, 文件头, NOTE, STYLE) 会被跳过
+    """
+    start, end, lines = None, None, []
+    for line in f:
+        line = line.rstrip("\r\n")
+        if line.strip() == "":
+            if start is not None:
+                yield SubEvent(start=start, end=end, text=CUE_TAG_RE.sub("", "\n".join(lines)))
+            start, end, lines = None, None, []
+            continue
+        if start is None:
+            if "-->" in line:
+                start_s, end_s = line.split("-->", 1)
+                start = parse_timestamp(start_s.strip())
+                end = parse_timestamp(end_s.strip().split(" ", 1)[0])
+            continue
+        lines.append(line)
+    if start is not None:
+        yield SubEvent(start=start, end=end, text=CUE_TAG_RE.sub("", "\n".join(lines)))
+
+
+def iter_srt(f: TextIO) -> Iterator[SubEvent]:
+    return iter_cues(f)
+
+
+def iter_vtt(f: TextIO) -> Iterator[SubEvent]:
+    return iter_cues(f)
+
+
 def merge_sub(sub: Sub) -> Sub:
     # try merge
     merged = Sub([])
@@ -183,13 +452,22 @@ def merge_sub(sub: Sub) -> Sub:
 
 
 def write_all(sub: Sub, base_dir, filename, formats) -> list[str]:
+    files = []
+    for filepath, content in render_all(sub, base_dir, filename, formats):
+        with open(filepath, "w", encoding='utf-8') as f:
+            f.write(content)
+        files.append(filepath)
+    return files
+
+
+def render_all(sub: Sub, base_dir, filename, formats) -> list[(str, str)]:
     writers = {
         'lrc': write_lrc,
         'srt': write_srt,
         'vtt': write_vtt,
         'txt': write_txt,
     }
-    files = []
+    rendered = []
     filename = sanitize_filename(filename)
     if not formats or len(formats) == 0:
         formats = ['lrc']
@@ -197,28 +475,25 @@ def write_all(sub: Sub, base_dir, filename, formats) -> list[str]:
         writer = writers[fmt]
         filepath = os.path.join(base_dir, f'{filename}.{fmt}')
         if writer:
-            with open(filepath, "w", encoding='utf-8') as f:
-                writer(sub, f)
-            files.append(filepath)
-    return files
+            f = io.StringIO()
+            writer(sub, f)
+            rendered.append((filepath, f.getvalue()))
+    return rendered
 
 
-def write_vtt(sub: Sub, f: TextIO):
-    lines = ["WebVTT\n\n"]
+def write_vtt(sub: Iterable[SubEvent], f: TextIO):
+    f.write("WEBVTT\n\n")
     for idx, event in enumerate(sub):
-        lines.append(f"{idx + 1}\n")
-        lines.append(f"{format_vtt_timestamp(event.start)} --> {format_vtt_timestamp(event.end)}\n")
-        lines.append(f"{event.text}\n\n")
-    f.writelines(lines)
+        f.write(f"{idx + 1}\n"
+                f"{format_vtt_timestamp(event.start)} --> {format_vtt_timestamp(event.end)}\n"
+                f"{event.text}\n\n")
 
 
-def write_srt(sub: Sub, f: TextIO):
-    lines = []
+def write_srt(sub: Iterable[SubEvent], f: TextIO):
     for idx, event in enumerate(sub):
-        lines.append(f"{idx + 1}\n")
-        lines.append(f"{format_srt_timestamp(event.start)} --> {format_srt_timestamp(event.end)}\n")
-        lines.append(f"{event.text}\n\n")
-    f.writelines(lines)
+        f.write(f"{idx + 1}\n"
+                f"{format_srt_timestamp(event.start)} --> {format_srt_timestamp(event.end)}\n"
+                f"{event.text}\n\n")
 
 
 def format_vtt_timestamp(seconds: float):
@@ -239,7 +514,7 @@ def format_timestamp(seconds: float, delim: str):
     seconds = milliseconds // 1_000
     milliseconds -= seconds * 1_000
     return (
-        f"{hours}{minutes:02d}:{seconds:02d}{delim}{milliseconds:03d}"
+        f"{hours:02d}:{minutes:02d}:{seconds:02d}{delim}{milliseconds:03d}"
     )
 
 
@@ -276,24 +551,36 @@ def parse_lrc_timestamp(s: str):
     return minutes*60 + seconds*1 + milliseconds*0.001
 
 
-def write_lrc(sub: Sub, f: TextIO):
-    lines = []
-    for idx, event in enumerate(sub):
+def parse_timestamp(s: str):
+    """
+    解析 srt/vtt 的时间, `hh:mm:ss,mmm` / `hh:mm:ss.mmm` / `mm:ss.mmm`
+    """
+    parts = s.replace(",", ".").split(":")
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def write_lrc(sub: Iterable[SubEvent], f: TextIO, word_timing: bool = False):
+    """
+    word_timing 为 True 时, 有逐字时间的行按 A2 扩展输出
+    """
+    prev_end_s = None
+    for event in sub:
         start_s = format_lrc_timestamp(event.start)
-        end_s = format_lrc_timestamp(event.end)
-        lines.append(f"[{start_s}]{event.text}\n")
-        if idx != len(sub) - 1:
-            next_start = sub[idx + 1].start
-            if next_start is not None:
-                next_start_s = format_lrc_timestamp(next_start)
-                if end_s == next_start_s:
-                    continue
-        lines.append(f"[{end_s}]\n")
-    f.writelines(lines)
-
-
-def write_txt(sub: Sub, f: TextIO):
-    lines = []
+        if prev_end_s is not None and prev_end_s != start_s:
+            f.write(f"[{prev_end_s}]\n")
+        text = event.text
+        if word_timing and event.words:
+            text = "".join(f"<{format_lrc_timestamp(word.start)}>{word.word}" for word in event.words)
+            text += f"<{format_lrc_timestamp(event.words[-1].end)}>"
+        f.write(f"[{start_s}]{text}\n")
+        prev_end_s = format_lrc_timestamp(event.end)
+    if prev_end_s is not None:
+        f.write(f"[{prev_end_s}]\n")
+
+
+def write_txt(sub: Iterable[SubEvent], f: TextIO):
     for event in sub:
-        lines.append(f"{event.text}\n")
-    f.writelines(lines)
+        f.write(f"{event.text}\n")
@@ -0,0 +1,44 @@
+import llm
+
+PROMPT_MARK = "将下面的日文文本翻译成中文："
+
+
+def prompt_lines(prompt: str) -> [str]:
+    """
+    prompt 中本次要翻译的行 (去掉作为上下文的历史)
+    """
+    text = prompt.rsplit(PROMPT_MARK, 1)[1].split("<|im_end|>")[0]
+    history = prompt.rsplit("<|im_start|>assistant\n", 1)[1]
+    return text.split("\n")[len([line for line in history.split("\n") if line]):]
+
+
+class StubModel:
+    """
+    代替 llm.Sakura, 把本次要翻译的每一行加上 ZH: 前缀返回
+    calls 记录每次调用的行, counted 记录 count_tokens 的参数
+    """
+
+    def __init__(self, text_length: int, max_sequences: int = 2):
+        self.cfg = llm.SakuraConfig("stub-v0.9-q", text_length=text_length, model_version="v0.9")
+        self.speculative_stats = llm.SpeculativeStats()
+        self.calls = []
+        self.counted = []
+        self._max_sequences = max_sequences
+
+    def count_tokens(self, text: str) -> int:
+        self.counted.append(text)
+        return len(text)
+
+    def max_sequences(self) -> int:
+        return self._max_sequences
+
+    def release(self, key):
+        pass
+
+    def completion(self, prompt: str, cfg) -> llm.SakuraCompletionResponse:
+        lines = prompt_lines(prompt)
+        self.calls.append(lines)
+        return llm.SakuraCompletionResponse(text="\n".join("ZH:" + line for line in lines), finish_reason="stop")
+
+    def completion_batch(self, prompts, cfg, keys=None):
+        return [self.completion(prompt, cfg) for prompt in prompts]
@@ -0,0 +1,59 @@
+import numpy as np
+
+import asr
+
+SR = asr.SAMPLE_RATE
+
+
+def noise(seconds: float, dbfs: float, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal(int(seconds * SR)).astype(np.float32)
+    return x / np.sqrt(np.mean(np.square(x))) * (10 ** (dbfs / 20))
+
+
+def voiced_seconds(audio: np.ndarray) -> float:
+    spans = asr.voiced_spans(audio)
+    return float((spans[:, 1] - spans[:, 0]).sum()) / SR
+
+
+def test_continuous_quiet_audio_is_kept():
+    audio = noise(40, -26)
+    assert voiced_seconds(audio) == len(audio) / SR
+
+
+def test_loud_then_quiet_speech_is_kept():
+    audio = np.concatenate([noise(60, -10, 1), noise(40, -26, 2)])
+    assert voiced_seconds(audio) == len(audio) / SR
+
+
+def test_whisper_without_silence_is_kept():
+    audio = np.concatenate([noise(30, -10, 1), noise(30, -45, 2)])
+    assert voiced_seconds(audio) == len(audio) / SR
+
+
+def test_silence_is_trimmed():
+    parts = []
+    for i in range(5):
+        parts.append(noise(5, -15, i))
+        parts.append(noise(10, -80, 10 + i))
+    audio = np.concatenate(parts)
+    # 5 段 5s 的声音, 每段前后最多保留 0.4s padding
+    assert 25 <= voiced_seconds(audio) <= 25 + 5 * 0.8 + 0.1
+
+
+def test_background_noise_is_trimmed():
+    parts = []
+    for i in range(5):
+        parts.append(noise(5, -15, i))
+        parts.append(noise(10, -58, 10 + i))
+    audio = np.concatenate(parts)
+    assert voiced_seconds(audio) <= 25 + 5 * 0.8 + 0.1
+
+
+def test_time_map_round_trip():
+    audio = np.concatenate([noise(5, -15, 1), noise(10, -80, 2), noise(5, -15, 3)])
+    trimmed, time_map = asr.trim_silence(audio)
+    assert len(trimmed) < len(audio)
+    # 第二段声音在拼接后的音频中的开头, 映射回原音频应该在 15s 附近 (减去 padding)
+    second = time_map.trimmed_starts[1]
+    assert abs(float(time_map.map(second)) - (15 - 0.4)) < 0.05
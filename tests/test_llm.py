@@ -0,0 +1,40 @@
+import numpy as np
+
+import llm
+
+
+def generation_config(**kwargs) -> llm.SakuraGenerationConfig:
+    return llm.SakuraGenerationConfig(**kwargs)
+
+
+def test_greedy_is_argmax():
+    logits = np.array([0.1, 2.0, 1.5, -1.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    assert llm.Sakura._sample(logits, [], generation_config(temperature=0.0), rng) == 1
+    assert llm.Sakura._sample(logits, [], generation_config(temperature=0.7, top_k=1), rng) == 1
+
+
+def test_repeat_penalty_counts_prompt_tokens():
+    # 和 llama.cpp 一样, prompt 中最近出现过的 token 也会被惩罚
+    logits = np.array([2.0, 1.9, 0.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    cfg = generation_config(temperature=0.0, repeat_penalty=1.2)
+    assert llm.Sakura._sample(logits, [0], cfg, rng) == 1
+    # 超出 PENALTY_LAST_N 的 token 不再惩罚
+    assert llm.Sakura._sample(logits, [0] + [2] * llm.PENALTY_LAST_N, cfg, rng) == 0
+
+
+def test_top_p_before_temperature():
+    # 原始分布下第一个 token 的概率已经超过 top_p, 之后的 token 被去掉, 和 temperature 无关
+    logits = np.array([3.0, 0.0, 0.0, 0.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    cfg = generation_config(temperature=5.0, top_p=0.8, min_p=0.0, top_k=0)
+    assert {llm.Sakura._sample(logits, [], cfg, rng) for _ in range(50)} == {0}
+
+
+def test_unset_parameters_use_llama_cpp_defaults():
+    # min_p 默认 0.05: 概率低于最高概率 5% 的 token 不会被选中
+    logits = np.array([5.0, 4.5, 0.0], dtype=np.float32)
+    rng = np.random.default_rng(0)
+    picks = {llm.Sakura._sample(logits, [], generation_config(), rng) for _ in range(200)}
+    assert picks == {0, 1}
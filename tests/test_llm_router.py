@@ -0,0 +1,108 @@
+import multiprocessing
+import re
+import threading
+import time
+
+import llm
+import llm_router
+import subs
+from stub_llm import StubModel
+from translate import SakuraLLMTranslator
+
+FILE_RE = re.compile(r"ファイル(\d+)の")
+
+
+class StubSakura(StubModel):
+    """
+    记录每次调用涉及的文件, crash_after 次批量调用之后模拟进程崩溃 (连接断开)
+    """
+
+    def __init__(self, crash_after: int = None):
+        super().__init__(40)
+        self.crash_after = crash_after
+        self.batches = 0
+        self.crashed_at = None
+        # (时间, 文件下标)
+        self.requests = []
+
+    def completion(self, prompt: str, cfg) -> llm.SakuraCompletionResponse:
+        response = super().completion(prompt, cfg)
+        self.requests.append((time.monotonic(), int(FILE_RE.search(self.calls[-1][0]).group(1))))
+        return response
+
+    def completion_batch(self, prompts, cfg, keys=None):
+        self.batches += 1
+        if self.crash_after is not None and self.batches > self.crash_after and self.crashed_at is None:
+            self.crashed_at = time.monotonic()
+            raise SystemExit
+        return super().completion_batch(prompts, cfg)
+
+
+class StubWorker(llm_router.Worker):
+    """
+    在线程中用 _serve_connection 服务, 和真实 worker 走同一套协议
+    """
+
+    def __init__(self, name: str, model: StubSakura):
+        super().__init__(name)
+        self.model = model
+        self.starts = 0
+
+    def _connect(self):
+        conn, child = multiprocessing.Pipe()
+        self.starts += 1
+
+        def run():
+            child.send(("ok", self.model.cfg, None))
+            try:
+                llm_router._serve_connection(self.model, child, threading.Lock())
+            except SystemExit:
+                pass
+            child.close()
+
+        threading.Thread(target=run, daemon=True).start()
+        return conn
+
+
+def test_router_sticky_retry_restart():
+    models = [StubSakura(), StubSakura(crash_after=1), StubSakura()]
+    workers = [StubWorker(f"stub-{i}", model) for i, model in enumerate(models)]
+    router = llm_router.Router(workers, restart_interval=1.0)
+    try:
+        assert router.max_sequences() == 6
+        translator = SakuraLLMTranslator(router.cfg, llm.SakuraGenerationConfig(), max_source_lines=2, model=router)
+        files = [subs.Sub(subs.SubEvent(i, i + 1, f"ファイル{f}の行番号{i}です") for i in range(5)) for f in range(8)]
+        results = {}
+        for index, progress in translator.translate_many(files):
+            if progress.finish:
+                results[index] = [event.text for event in progress.data]
+
+        assert results == {f: [f"ZH:ファイル{f}の行番号{i}です" for i in range(5)] for f in range(8)}
+        assert models[1].crashed_at is not None
+        assert workers[1] not in router._healthy()
+
+        # 每个文件固定在一个 worker 上, 只有崩溃的 worker 上的文件换到另一个 worker 重试
+        served = {f: [] for f in range(8)}
+        for _, f, i in sorted((t, f, i) for i, model in enumerate(models) for t, f in model.requests):
+            served[f].append(i)
+        moved = {f for f in range(8) if 1 in served[f]}
+        assert len(moved) > 0
+        for f, indexes in served.items():
+            if f in moved:
+                before = indexes[:indexes.count(1)]
+                after = set(indexes[len(before):])
+                assert before == [1] * len(before) and len(after) == 1 and 1 not in after
+            else:
+                assert len(set(indexes)) == 1
+        # 崩溃之后到重启之前没有再收到请求
+        assert all(t < models[1].crashed_at for t, _ in models[1].requests)
+        assert workers[1].starts == 1
+
+        time.sleep(router.restart_interval + 0.1)
+        deadline = time.monotonic() + 5
+        while workers[1] not in router._healthy() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert workers[1] in router._healthy()
+        assert workers[1].starts == 2
+    finally:
+        router.close()
@@ -0,0 +1,18 @@
+import llm
+import llm_tune
+
+
+def test_tune_measures_smaller_n_batch(monkeypatch):
+    measured = []
+
+    def benchmark(cfg, gen, llama_config, rounds):
+        measured.append(dict(llama_config))
+        # batch 越小越快, 让搜索停在 n_batch=256
+        seconds = llama_config["n_batch"] / 256 + llama_config["n_ubatch"] / 1024
+        return {"seconds": seconds, "tokens_per_second": 1 / seconds}
+
+    monkeypatch.setattr(llm_tune, "benchmark", benchmark)
+    best, _ = llm_tune.tune(llm.SakuraConfig("stub-v0.9-q", use_gpu=True, text_length=1024))
+    assert {"n_batch": 256, "n_ubatch": 256, "flash_attn": False} in measured
+    assert all(llm_tune.valid(config) for config in measured)
+    assert best["n_batch"] == 256 and best["n_ubatch"] == 128
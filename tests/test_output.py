@@ -0,0 +1,35 @@
+import os
+import threading
+
+import output
+import subs
+
+
+def test_pending_files_only_returns_written_files(tmp_path, monkeypatch):
+    release = threading.Event()
+    write_text = output.write_text
+
+    def slow_write_text(filepath, content):
+        release.wait(5)
+        write_text(filepath, content)
+
+    monkeypatch.setattr(output, "write_text", slow_write_text)
+    writer = output.Writer()
+    pending = output.PendingFiles()
+    sub = subs.Sub([subs.SubEvent(0.0, 1.0, "テスト")])
+    pending.add(writer.write_sub(sub, str(tmp_path), "a", ["lrc", "txt"]))
+    assert pending.ready() == []
+    release.set()
+    files = pending.wait()
+    assert [os.path.basename(f) for f in files] == ["a.lrc", "a.txt"]
+    assert all(os.path.exists(f) for f in files)
+    writer.flush()
+
+
+def test_pending_files_keeps_submission_order(tmp_path):
+    writer = output.Writer()
+    pending = output.PendingFiles()
+    for name in ("a", "b", "c"):
+        pending.add(writer.write_sub(subs.Sub([subs.SubEvent(0.0, 1.0, name)]), str(tmp_path), name, ["txt"]))
+    writer.flush()
+    assert [os.path.basename(f) for f in pending.ready()] == ["a.txt", "b.txt", "c.txt"]
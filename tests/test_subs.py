@@ -0,0 +1,25 @@
+import subs
+
+
+def key(text):
+    return subs.normalize_text(text)
+
+
+def test_normalize_merges_punctuation_and_elongation():
+    assert key("ああああ") == key("あああ")
+    assert key("はぁ、はぁ") == key("はぁはぁ")
+    assert key("そうですね。") == key("そうですね")
+    assert key("すごーーーい") == key("すごーい")
+
+
+def test_normalize_keeps_meaningful_differences():
+    assert key("100円です") != key("10円です")
+    assert key("ここ") != key("こ")
+    assert key("そう？") != key("そう。")
+    assert key("本当！") != key("本当")
+    assert key("AAA") != key("A")
+    assert key("ああ") != key("あ")
+
+
+def test_normalize_punctuation_only_line():
+    assert key("……") == "……"
@@ -0,0 +1,113 @@
+import random
+import sqlite3
+
+import subs
+import tm
+
+
+def memory(tmp_path, **kwargs) -> tm.TranslationMemory:
+    return tm.TranslationMemory(str(tmp_path / "memory.db"), **kwargs)
+
+
+def test_exact_hit(tmp_path):
+    m = memory(tmp_path)
+    m.add("今日はいい天気ですね", "今天天气真好呢")
+    assert m.lookup("今日はいい天気ですね") == ("今天天气真好呢", 1.0)
+    # 全角半角和空白差异仍然算精确命中
+    m.add("ＡＢＣの歌 ", "ABC之歌")
+    assert m.lookup("ABCの歌") == ("ABC之歌", 1.0)
+
+
+def test_fuzzy_hit(tmp_path):
+    m = memory(tmp_path)
+    if not m.fuzzy:
+        return
+    m.add("今日はとてもいい天気ですね、散歩に行きましょう", "今天天气真好呢，去散步吧")
+    trs, score = m.lookup("今日はとてもいい天気ですね、散歩に行きましょうか")
+    assert trs == "今天天气真好呢，去散步吧"
+    assert m.threshold <= score < 1.0
+    assert m.lookup("明日は雨が降るそうです") == (None, 0.0)
+
+
+def test_empty_output_not_stored(tmp_path):
+    m = memory(tmp_path)
+    m.add("今日はいい天気ですね", "")
+    m.add("明日は雨が降るそうです", "  \n")
+    assert m.lookup("今日はいい天気ですね") == (None, 0.0)
+    assert m.lookup("明日は雨が降るそうです") == (None, 0.0)
+
+
+def test_numbers_not_confused(tmp_path):
+    m = memory(tmp_path)
+    m.add("このりんごは100円です", "这个苹果100日元")
+    assert m.lookup("このりんごは10円です") == (None, 0.0)
+    assert m.lookup("このりんごは100円です") == ("这个苹果100日元", 1.0)
+
+
+def test_meaningful_differences_not_merged(tmp_path):
+    m = memory(tmp_path, threshold=0.99)
+    m.add("本当", "真的")
+    m.add("本当？", "真的？")
+    assert m.lookup("本当") == ("真的", 1.0)
+    assert m.lookup("本当？") == ("真的？", 1.0)
+
+
+def test_migrate_old_keys(tmp_path):
+    path = str(tmp_path / "memory.db")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE memory ("
+        "id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, src TEXT NOT NULL, trs TEXT NOT NULL)"
+    )
+    for src, trs in [("本当？", "真的？"), ("失敗した行です", "")]:
+        db.execute("INSERT INTO memory (key, src, trs) VALUES (?, ?, ?)", (subs.normalize_text(src), src, trs))
+    db.commit()
+    db.close()
+    m = tm.TranslationMemory(path)
+    assert m.lookup("本当？") == ("真的？", 1.0)
+    assert m.lookup("失敗した行です") == (None, 0.0)
+    m.close()
+    # 再次打开时不重复升级
+    m = tm.TranslationMemory(path)
+    assert m.lookup("本当？") == ("真的？", 1.0)
+
+
+def test_fuzzy_hit_among_filler(tmp_path):
+    """
+    大量和原文共享 trigram 的行 (每个 trigram 约 60 行) 不会把真正相近的行挤出候选
+    """
+    m = memory(tmp_path)
+    if not m.fuzzy:
+        return
+    src = "今日はとてもいい天気ですね散歩に行きましょう"
+    rng = random.Random(0)
+    pool = "春夏秋冬東西南北山川海空雲雨雪風花鳥月星火水木金土"
+    for gram in set(tm.ngrams(tm.match_key(src))):
+        for _ in range(60):
+            filler = "".join(rng.choice(pool) for _ in range(20))
+            at = rng.randrange(len(filler))
+            m.add(filler[:at] + gram + filler[at:], "填充")
+    # 最后写入, 不按相关度排序时 sqlite 先返回前面的行
+    m.add(src, "今天天气真好，去散步吧")
+    assert tm.similarity(tm.match_key(src), tm.match_key(src + "か")) > m.threshold
+    trs, score = m.lookup(src + "か")
+    assert trs == "今天天气真好，去散步吧"
+    assert m.threshold <= score < 1.0
+
+
+def test_punctuation_elongation_particle(tmp_path):
+    m = memory(tmp_path)
+    m.add("はい", "是")
+    m.add("あああ", "啊")
+    m.add("気持ちいいですね", "好舒服呢")
+    # 标点
+    assert m.lookup("はい。") == ("是", 1.0)
+    assert m.lookup("はい！") == ("是", 1.0)
+    # 拉长音
+    assert m.lookup("ああああ") == ("啊", 1.0)
+    # 句末语气词
+    assert m.lookup("気持ちいいですよ") == ("好舒服呢", 1.0)
+    assert m.stats.exact == 0 and m.stats.fuzzy == 4
+    # 不是语气词的结尾不受影响
+    m.add("みんな", "大家")
+    assert m.lookup("みん") == (None, 0.0)
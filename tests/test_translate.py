@@ -0,0 +1,95 @@
+import llm
+import subs
+import tm
+from stub_llm import StubModel
+from translate import SakuraLLMTranslator
+
+
+def translate(lines, text_length=20, max_source_lines=3):
+    model = StubModel(text_length)
+    translator = SakuraLLMTranslator(model.cfg, llm.SakuraGenerationConfig(), max_source_lines=max_source_lines, model=model)
+    result = None
+    for progress in translator.translate(subs.Sub(subs.SubEvent(i, i + 1, line) for i, line in enumerate(lines))):
+        result = progress
+    assert result.finish
+    return [event.text for event in result.data], model.calls
+
+
+def test_line_longer_than_text_length():
+    long_line = "これはとても長い一行のテキストで二十文字を超えています"
+    texts, calls = translate([long_line, "短い行です", "もう一つの行"])
+    assert texts == ["ZH:" + long_line, "ZH:短い行です", "ZH:もう一つの行"]
+    assert all(len(call) > 0 for call in calls)
+
+
+def test_only_long_lines():
+    lines = ["これはとても長い一行のテキストで二十文字を超えています", "二行目も同じように長くて一つのグループには入りません"]
+    texts, calls = translate(lines)
+    assert texts == ["ZH:" + line for line in lines]
+    assert calls == [[lines[0]], [lines[1]]]
+
+
+def test_dedupe_keeps_numbers_apart():
+    texts, calls = translate(["100円です", "10円です", "100円です。"], text_length=1024)
+    assert texts == ["ZH:100円です", "ZH:10円です", "ZH:100円です"]
+    assert calls == [["100円です", "10円です"]]
+
+
+class DropLineModel(StubModel):
+    """
+    多行请求时少返回一行, 触发逐行回退
+    """
+
+    def completion(self, prompt: str, cfg) -> llm.SakuraCompletionResponse:
+        response = super().completion(prompt, cfg)
+        if len(self.calls[-1]) > 1:
+            response.text = response.text.split("\n", 1)[1]
+        return response
+
+
+def test_memory_skips_fallback_lines(tmp_path):
+    model = DropLineModel(1024)
+    memory = tm.TranslationMemory(str(tmp_path / "memory.db"))
+    translator = SakuraLLMTranslator(model.cfg, llm.SakuraGenerationConfig(), memory=memory, model=model)
+    lines = ["今日はいい天気ですね", "明日は雨が降るそうです"]
+    result = list(translator.translate(subs.Sub(subs.SubEvent(i, i + 1, line) for i, line in enumerate(lines))))[-1]
+    assert [event.text for event in result.data] == ["ZH:" + line for line in lines]
+    assert all(memory.lookup(line) == (None, 0.0) for line in lines)
+
+
+def test_dedupe_counts_tokens_once_per_key(capsys):
+    model = StubModel(1024)
+    translator = SakuraLLMTranslator(model.cfg, llm.SakuraGenerationConfig(), model=model)
+    lines = ["あっ", "気持ちいい"] * 500
+    result = list(translator.translate(subs.Sub(subs.SubEvent(i, i + 1, line) for i, line in enumerate(lines))))[-1]
+    assert [event.text for event in result.data] == ["ZH:" + line for line in lines]
+    assert sorted(model.counted) == ["あっ\n", "気持ちいい\n"]
+    assert "跳过 998 行重复, 节省约 4491 个输入token" in capsys.readouterr().out
+
+
+class SpeculativeModel(StubModel):
+    """
+    每次调用提议 10 个 token, 第一个文件接受 8 个, 之后接受 4 个
+    """
+
+    def __init__(self, text_length: int):
+        super().__init__(text_length)
+        self.cfg.speculative = "prompt_lookup"
+        self.accept = 8
+
+    def completion(self, prompt: str, cfg) -> llm.SakuraCompletionResponse:
+        self.speculative_stats.proposed += 10
+        self.speculative_stats.accepted += self.accept
+        self.speculative_stats.completion_tokens += 10
+        self.speculative_stats.seconds += 1.0
+        return super().completion(prompt, cfg)
+
+
+def test_speculative_stats_per_file(capsys):
+    model = SpeculativeModel(1024)
+    translator = SakuraLLMTranslator(model.cfg, llm.SakuraGenerationConfig(), model=model)
+    list(translator.translate(subs.Sub([subs.SubEvent(0, 1, "一つ目のファイルです")])))
+    model.accept = 4
+    list(translator.translate(subs.Sub([subs.SubEvent(0, 1, "二つ目のファイルです")])))
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith("投机解码")]
+    assert lines == ["投机解码: 接受率 80.0%, 10.0 tokens/s", "投机解码: 接受率 40.0%, 10.0 tokens/s"]
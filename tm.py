@@ -0,0 +1,235 @@
+import collections
+import re
+import sqlite3
+import threading
+import unicodedata
+
+import subs
+
+# 数据库格式版本, 变化时按保存的原文重建 key 和索引
+SCHEMA_VERSION = 2
+WHITESPACE_RE = re.compile(r"\s+")
+DIGITS_RE = re.compile(r"\d+")
+MATCH_MARK_RE = re.compile(r"[!?]+")
+# 句末语气词, 只在常见的谓语结尾之后去掉 (みんな / おかね 这类词不受影响)
+TRAILING_PARTICLE_RE = re.compile(r"(?<=[すだたいうるくぐむぶつぬ])[ねよなわぞぜさ]+$")
+
+
+def memory_key(text: str) -> str:
+    """
+    精确匹配用的 key, 只做 NFKC 和空白规整, 不去标点也不合并重复字符
+    (去重用的 subs.normalize_text 是有损的, 写进持久化的记忆里错误会一直保留)
+    """
+    return WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def match_key(text: str) -> str:
+    """
+    相似匹配用的形式: 在 subs.normalize_text 的基础上再去掉 !? 和句末语气词,
+    只有标点, 拉长音或者句末语气词不同的行得到相同的结果, 短行也可以直接比较
+    """
+    normalized = MATCH_MARK_RE.sub("", subs.normalize_text(text))
+    stripped = TRAILING_PARTICLE_RE.sub("", normalized)
+    if stripped != "":
+        return stripped
+    if normalized != "":
+        return normalized
+    return memory_key(text)
+
+
+def ngrams(text: str, n: int = 3) -> collections.Counter:
+    if len(text) < n:
+        return collections.Counter([text])
+    return collections.Counter(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    字符 3-gram 的 Dice 系数
+    """
+    if a == b:
+        return 1.0
+    ga, gb = ngrams(a), ngrams(b)
+    total = sum(ga.values()) + sum(gb.values())
+    if total == 0:
+        return 0.0
+    return 2 * sum((ga & gb).values()) / total
+
+
+class MemoryStats:
+    def __init__(self):
+        self.lookups = 0
+        self.exact = 0
+        self.fuzzy = 0
+
+    def hits(self) -> int:
+        return self.exact + self.fuzzy
+
+    def hit_rate(self) -> float:
+        return self.hits() / self.lookups if self.lookups > 0 else 0.0
+
+
+class TranslationMemory:
+    """
+    持久化的翻译记忆, 保存在 sqlite 中
+    先按 memory_key 精确匹配, 再按 match_key 比较, 都没有命中时用 FTS5 的 trigram 索引找候选,
+    只用文档频率最低的几个 trigram 查询, 候选集很小, 百万行规模下查询也在亚毫秒级
+    候选和原文的相似度不低于 threshold 且数字完全相同时复用其译文
+    """
+
+    # 查询时使用的 trigram 个数
+    QUERY_NGRAMS = 4
+    # 参与相似度计算的候选个数
+    MAX_CANDIDATES = 32
+
+    def __init__(self, path: str, threshold: float = 0.85):
+        self.path = path
+        self.threshold = threshold
+        self.stats = MemoryStats()
+        # gradio 的生成器每一步可能在不同线程执行
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # key: memory_key, 精确匹配; norm: match_key, 相似匹配和 trigram 索引都基于它
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS memory ("
+            "id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, norm TEXT NOT NULL DEFAULT '', "
+            "src TEXT NOT NULL, trs TEXT NOT NULL)"
+        )
+        rows = self._migrate()
+        self._db.execute("CREATE INDEX IF NOT EXISTS memory_norm ON memory (norm)")
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memory_fts USING fts5(norm, tokenize='trigram')")
+            # 每个 trigram 出现在多少行, 用来挑出最少见的 trigram (fts5vocab 统计时要扫描整个倒排表, 太慢)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS memory_ngram (term TEXT PRIMARY KEY, doc INTEGER NOT NULL) WITHOUT ROWID"
+            )
+            self.fuzzy = True
+        except sqlite3.OperationalError as e:
+            # sqlite 版本低于 3.34 时没有 trigram 分词器, 只做精确匹配
+            print(f"warning, translation memory fuzzy match disabled: {e}")
+            self.fuzzy = False
+        for src, trs in rows:
+            # 旧版本会保存调用失败时的空译文
+            if trs.strip() != "":
+                self._add(src, trs)
+        self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.commit()
+
+    def _migrate(self) -> [(str, str)]:
+        """
+        旧版本的数据库清空后返回原有的 (原文, 译文), 由 __init__ 在建好索引后重新写入
+        版本 0 的 key 是有损的 subs.normalize_text, 版本 1 的 trigram 索引建在 key 上
+        """
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return []
+        rows = self._db.execute("SELECT src, trs FROM memory ORDER BY id").fetchall()
+        if len(rows) > 0:
+            print(f"翻译记忆: 升级数据库格式, 重建 {len(rows)} 行的索引")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(memory)")]
+        if "norm" not in columns:
+            self._db.execute("ALTER TABLE memory ADD COLUMN norm TEXT NOT NULL DEFAULT ''")
+        self._db.execute("DELETE FROM memory")
+        self._db.execute("DROP TABLE IF EXISTS memory_fts")
+        self._db.execute("DROP TABLE IF EXISTS memory_ngram")
+        return rows
+
+    def lookup(self, text: str) -> (str, float):
+        """
+        返回 (译文, 相似度), 没有命中时返回 (None, 0.0)
+        match_key 相同的行相似度为 1.0, 但计入相似命中
+        """
+        key = memory_key(text)
+        norm = match_key(text)
+        with self._lock:
+            self.stats.lookups += 1
+            row = self._db.execute("SELECT trs FROM memory WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0].strip() != "":
+                self.stats.exact += 1
+                return row[0], 1.0
+            best, best_score = None, 0.0
+            # 短行没有 trigram, 只比较 match_key, 有多行时选原文最接近的
+            for candidate, trs in self._db.execute("SELECT key, trs FROM memory WHERE norm = ?", (norm,)):
+                score = similarity(key, candidate)
+                if trs.strip() != "" and (best is None or score > best_score):
+                    best, best_score = trs, score
+            if best is not None:
+                self.stats.fuzzy += 1
+                return best, 1.0
+            if not self.fuzzy or len(norm) < 3:
+                return None, 0.0
+            n = max(len(norm) - 2, 1)
+            digits = DIGITS_RE.findall(norm)
+            for candidate, trs in self._candidates(norm):
+                # 长度差太多的不可能达到阈值
+                m = max(len(candidate) - 2, 1)
+                if 2 * min(n, m) / (n + m) < self.threshold:
+                    continue
+                # 数字不同的句子 (100円 / 200円) 译文不能复用
+                if DIGITS_RE.findall(candidate) != digits or trs.strip() == "":
+                    continue
+                score = similarity(norm, candidate)
+                if score > best_score:
+                    best, best_score = trs, score
+            if best is not None and best_score >= self.threshold:
+                self.stats.fuzzy += 1
+                return best, best_score
+            return None, 0.0
+
+    def _candidates(self, norm: str) -> [(str, str)]:
+        """
+        用最少见的几个 trigram 做 OR 查询, 按 bm25 排序后取前 MAX_CANDIDATES 个,
+        共有的 (少见) trigram 越多越靠前, 常见 trigram 很多时也不会漏掉真正相近的行
+        """
+        grams = list(set(ngrams(norm)))
+        placeholders = ",".join("?" * len(grams))
+        rows = self._db.execute(
+            f"SELECT term FROM memory_ngram WHERE term IN ({placeholders}) ORDER BY doc LIMIT ?",
+            (*grams, self.QUERY_NGRAMS),
+        ).fetchall()
+        if len(rows) == 0:
+            return []
+        query = " OR ".join('"' + row[0].replace('"', '""') + '"' for row in rows)
+        return self._db.execute(
+            "SELECT m.norm, m.trs FROM memory m JOIN ("
+            "SELECT rowid, rank FROM memory_fts WHERE memory_fts MATCH ? ORDER BY rank LIMIT ?"
+            ") f ON m.id = f.rowid ORDER BY f.rank",
+            (query, self.MAX_CANDIDATES),
+        ).fetchall()
+
+    def add(self, src: str, trs: str):
+        """
+        空的译文 (模型调用失败) 不保存, 否则之后的任务会一直复用空行
+        """
+        if trs.strip() == "" or src.strip() == "":
+            return
+        with self._lock:
+            self._add(src, trs)
+
+    def _add(self, src: str, trs: str):
+        key = memory_key(src)
+        row = self._db.execute("SELECT id FROM memory WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("UPDATE memory SET src = ?, trs = ? WHERE id = ?", (src, trs, row[0]))
+            return
+        norm = match_key(key)
+        cur = self._db.execute(
+            "INSERT INTO memory (key, norm, src, trs) VALUES (?, ?, ?, ?)", (key, norm, src, trs),
+        )
+        if self.fuzzy:
+            self._db.execute("INSERT INTO memory_fts (rowid, norm) VALUES (?, ?)", (cur.lastrowid, norm))
+            self._db.executemany(
+                "INSERT INTO memory_ngram (term, doc) VALUES (?, 1) ON CONFLICT(term) DO UPDATE SET doc = doc + 1",
+                ((gram,) for gram in ngrams(norm) if len(gram) == 3),
+            )
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
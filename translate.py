@@ -1,13 +1,19 @@
 import copy
 import collections
+import dataclasses
 from pprint import pprint
 
 import dicts
 import subs
 import llm
+import tm
 
 
 class Progress:
+    """
+    finish 为 False 时 data 只包含上次之后新翻译的行, 为 True 时 data 为完整的翻译结果
+    """
+
     def __init__(self, current: float, total: float, desc: str, data: any, finish: bool):
         self.current = float(current)
         self.total = float(total)
@@ -16,26 +22,23 @@ class Progress:
         self.finish = finish
 
 
-class SakuraLLMTranslator:
-    LINE_BREAK = "\n"
+class Request:
+    def __init__(self, prompt: str):
+        self.prompt = prompt
 
-    def __init__(
-            self,
-            cfg: llm.SakuraConfig,
-            gc: llm.SakuraGenerationConfig,
-            show_progress=False,
-            max_source_lines=30,
-    ):
-        self.model = llm.Sakura(cfg)
-        self.generation_config = gc
-        self.gpt_dict = dicts.gpt_dict
+
+class HistoryChain:
+    """
+    一个文件的翻译历史, 作为上下文拼进 prompt
+    """
+
+    def __init__(self, text_length: int, show_progress=False):
         self.history = collections.deque([])
         self.history_length = 0
+        self.text_length = text_length
         self.show_progress = show_progress
-        self.max_source_lines = max_source_lines
-        self.cache = {}
 
-    def history_append(self, src: str, trs: str):
+    def append(self, src: str, trs: str):
         if len(src) <= 5:
             return
         if len(self.history) > 0:
@@ -44,70 +47,230 @@ class SakuraLLMTranslator:
                 return
         self.history.append((src, trs))
         self.history_length += len(src) + len(trs) + 2
-        while self.history_length > self.model.cfg.text_length:
+        while self.history_length > self.text_length:
             l_src, l_trs = self.history.popleft()
             self.history_length -= (len(l_src) + len(l_trs) + 2)
         if self.show_progress:
             print(f"trs from: {src}")
             print(f"      to: {trs}")
 
+
+class SakuraLLMTranslator:
+    LINE_BREAK = "\n"
+
+    def __init__(
+            self,
+            cfg: llm.SakuraConfig,
+            gc: llm.SakuraGenerationConfig,
+            show_progress=False,
+            max_source_lines=30,
+            memory: tm.TranslationMemory = None,
+            model=None,
+    ):
+        # model 可以是 llm_router.Router, 在多个 Sakura 实例之间分配请求
+        self.model = model if model is not None else llm.Sakura(cfg)
+        self.generation_config = gc
+        self.gpt_dict = dicts.gpt_dict
+        self.show_progress = show_progress
+        self.chain = self.new_chain()
+        self.max_source_lines = max_source_lines
+        self.cache = {}
+        # 跨任务持久化的翻译记忆, 相同或相近的行直接复用译文
+        self.memory = memory
+
+    def new_chain(self) -> HistoryChain:
+        return HistoryChain(self.model.cfg.text_length, self.show_progress)
+
     def translate_file(self, file):
         sub = subs.Sub.load_file(file)
         return self.translate(sub)
 
     def translate(self, sub: subs.Sub):
+        """
+        单个文件, 使用翻译器自身的历史, 多个文件依次调用时历史是连续的
+        """
+        steps = self._translate_steps(sub, self.chain)
+        response = None
+        while True:
+            try:
+                step = steps.send(response)
+            except StopIteration:
+                return
+            response = None
+            if isinstance(step, Request):
+                response = self.model.completion(step.prompt, self.generation_config)
+            else:
+                yield step
+
+    def translate_many(self, ss):
+        """
+        多个文件同时翻译, 每个文件有自己的历史
+        每轮把各个文件的下一组文本作为不同序列, 放进同一个 llama.cpp context 批量解码
+        同时进行的文件数受 kv cache 大小限制 (SakuraConfig.n_parallel)
+        返回 (文件下标, Progress)
+        """
+        pending = enumerate(ss)
+        # 文件下标 -> [steps, 待传回的 response]
+        active = {}
+        exhausted = False
+        while True:
+            requests = {}
+            queue = list(active.keys())
+            while True:
+                # 有文件结束时马上补上新文件, 让这一轮的 batch 尽量满
+                while not exhausted and len(active) < self.model.max_sequences():
+                    try:
+                        index, sub = next(pending)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    active[index] = [self._translate_steps(sub, self.new_chain()), None]
+                    queue.append(index)
+                if len(queue) == 0:
+                    break
+                # 推进一个文件, 直到它提出下一个翻译请求或者结束
+                index = queue.pop(0)
+                steps, response = active[index]
+                active[index][1] = None
+                while True:
+                    try:
+                        step = steps.send(response)
+                    except StopIteration:
+                        del active[index]
+                        self.model.release(index)
+                        break
+                    response = None
+                    if isinstance(step, Request):
+                        requests[index] = step
+                        break
+                    yield index, step
+            if len(requests) == 0:
+                return
+            indexes = list(requests.keys())
+            responses = self.model.completion_batch(
+                [requests[index].prompt for index in indexes], self.generation_config, keys=indexes,
+            )
+            for index, response in zip(indexes, responses):
+                active[index][1] = response
+
+    def _translate_steps(self, sub: subs.Sub, chain: HistoryChain):
+        """
+        翻译过程, 需要调用模型时 yield Request, 通过 send 传回结果, 其他时候 yield Progress
+        """
         sub = [event.clean_ja() for event in sub]
-        grouped: [[subs.SubEvent]] = []
-        current: [subs.SubEvent] = []
-        current_chars: int = 0
-        for line in sub:
-            if current_chars + len(line.text) > self.model.cfg.text_length or len(current) >= self.max_source_lines:
-                grouped.append(current)
-                current, current_chars = [], 0
-            current.append(line)
-            current_chars += len(line.text)
-        if len(current) > 0:
-            grouped.append(current)
-            current, current_chars = [], 0
+        # speculative_stats 是整个模型的累计值, 记下开始时的快照, 结束时输出这个文件期间的增量
+        # (translate_many 中同时翻译的文件共用模型, 增量也包含同一时间其他文件的解码)
+        speculative_start = dataclasses.replace(self.model.speculative_stats)
+        # 去重, 重复的行 (包括之前文件翻译过的) 不发给模型, 翻译完之后从缓存填回去
+        keys = [subs.normalize_text(line.text) for line in sub]
+        unique: [int] = []
+        seen = set()
+        # key -> [跳过的次数, 其中一行的原文]
+        skipped = {}
+        for i, line in enumerate(sub):
+            if line.text == "":
+                continue
+            if keys[i] in seen or keys[i] in self.cache:
+                skipped.setdefault(keys[i], [0, line.text])[0] += 1
+                continue
+            seen.add(keys[i])
+            unique.append(i)
+        if len(skipped) > 0:
+            # 每个 key 只统计一次 token 数, 使用 Router 时每次统计都是一次进程间 / 网络调用
+            skipped_lines = sum(n for n, _ in skipped.values())
+            skipped_tokens = sum(n * self.model.count_tokens(text + self.LINE_BREAK) for n, text in skipped.values())
+            print(f"去重: 跳过 {skipped_lines} 行重复, 节省约 {skipped_tokens} 个输入token")
+        if self.memory is not None and len(unique) > 0:
+            calls_before = len(self._group(sub, unique))
+            exact, fuzzy = self.memory.stats.exact, self.memory.stats.fuzzy
+            missed: [int] = []
+            for i in unique:
+                trs, _ = self.memory.lookup(sub[i].text)
+                if trs is None:
+                    missed.append(i)
+                else:
+                    self.cache[keys[i]] = trs
+            exact, fuzzy = self.memory.stats.exact - exact, self.memory.stats.fuzzy - fuzzy
+            print(f"翻译记忆: 命中 {exact + fuzzy}/{len(unique)} 行 ({(exact + fuzzy) / len(unique):.1%}), "
+                  f"精确 {exact}, 相似 {fuzzy}, 减少 {calls_before - len(self._group(sub, missed))} 次模型调用")
+            unique = missed
+        grouped = self._group(sub, unique)
         translated: [subs.SubEvent] = []
-        yield Progress(len(translated), len(sub), '', translated, False)
-        for current in grouped:
-            non_empty = list(line.text for line in current if line.text != '')
-            response = self._translate(self.LINE_BREAK.join(non_empty))
+
+        def fill(until: int):
+            # 按原顺序输出, 直到 until (不含), 这之前的行都已经在缓存里了
+            while len(translated) < until:
+                line = sub[len(translated)]
+                cpy: subs.SubEvent = copy.copy(line)
+                if line.text != "":
+                    cpy.text = self.cache[keys[len(translated)]]
+                    cpy.clean_zh(line.text)
+                    chain.append(line.text, cpy.text)
+                translated.append(cpy)
+
+        reported = 0
+
+        def delta():
+            nonlocal reported
+            lines, reported = translated[reported:], len(translated)
+            return lines
+
+        yield Progress(len(translated), len(sub), '', delta(), False)
+        for g, current in enumerate(grouped):
+            next_unique = grouped[g+1][0] if g+1 < len(grouped) else len(sub)
+            fill(current[0])
+            non_empty = list(sub[i].text for i in current)
+            response = yield Request(self.get_prompt(self.LINE_BREAK.join(non_empty), chain))
             contents = response.text.split(self.LINE_BREAK)
             if len(contents) == len(non_empty):
-                i = 0
-                for line in current:
-                    if line.text == "":
-                        translated.append(line)
-                        continue
-                    cpy: subs.SubEvent = copy.copy(line)
-                    cpy.text = contents[i]
-                    cpy.clean_zh(line.text)
-                    translated.append(cpy)
-                    self.history_append(line.text, cpy.text)
-                    self.cache[line.text] = cpy.text
-                    i += 1
-                yield Progress(len(translated), len(sub), '', translated, False)
+                for i, content in zip(current, contents):
+                    self.cache[keys[i]] = content
+                    self._remember(sub[i].text, content)
+                fill(next_unique)
+                yield Progress(len(translated), len(sub), '', delta(), False)
             else:
                 self._warning_lines_mismatch(non_empty, contents)
                 # retry line by line
                 print("回退至逐行翻译模式")
-                for line in current:
-                    cpy: subs.SubEvent = copy.copy(line)
-                    if line.text != "":
-                        cached = self.cache.get(line.text)
-                        if cached is not None:
-                            cpy.text = cached
-                        else:
-                            cpy.text = self._translate(line.text).text.replace("\n", " ")
-                            cpy.clean_zh(line.text)
-                    translated.append(cpy)
-                    self.history_append(line.text, cpy.text)
-                    self.cache[line.text] = cpy.text
-                    yield Progress(len(translated), len(sub), '', translated, False)
+                for n, i in enumerate(current):
+                    if keys[i] not in self.cache:
+                        response = yield Request(self.get_prompt(sub[i].text, chain))
+                        # 逐行回退的结果质量没有保证, 只在本次任务中使用, 不写进翻译记忆
+                        self.cache[keys[i]] = response.text.replace("\n", " ")
+                    fill(current[n+1] if n+1 < len(current) else next_unique)
+                    yield Progress(len(translated), len(sub), '', delta(), False)
+        fill(len(sub))
+        if self.memory is not None:
+            self.memory.commit()
+        if self.model.cfg.speculative is not None:
+            stats = self.model.speculative_stats.since(speculative_start)
+            print(f"投机解码: 接受率 {stats.acceptance_rate():.1%}, {stats.tokens_per_second():.1f} tokens/s")
         yield Progress(len(translated), len(sub), '', translated, True)
 
+    def _group(self, sub: [subs.SubEvent], indices: [int]) -> [[int]]:
+        """
+        按 text_length 和 max_source_lines 把要翻译的行分组, 每组一次模型调用
+        """
+        grouped: [[int]] = []
+        current: [int] = []
+        current_chars: int = 0
+        for i in indices:
+            line = sub[i]
+            full = current_chars + len(line.text) > self.model.cfg.text_length or len(current) >= self.max_source_lines
+            # 超过 text_length 的单行自成一组, 不产生空组
+            if full and len(current) > 0:
+                grouped.append(current)
+                current, current_chars = [], 0
+            current.append(i)
+            current_chars += len(line.text)
+        if len(current) > 0:
+            grouped.append(current)
+        return grouped
+
+    def _remember(self, src: str, trs: str):
+        if self.memory is not None:
+            self.memory.add(src, trs)
+
     def _warning_lines_mismatch(self, srcs, trss):
         print(f"多行翻译返回结果行数不匹配, 输入[{len(srcs)}]行, 返回[{len(trss)}]行:")
         print("对比:")
@@ -124,8 +287,10 @@ class SakuraLLMTranslator:
         prompt = self.get_prompt(text)
         return self.model.completion(prompt, self.generation_config)
 
-    def get_prompt(self, text: str):
-        history = list(self.history)
+    def get_prompt(self, text: str, chain: HistoryChain = None):
+        if chain is None:
+            chain = self.chain
+        history = list(chain.history)
         user = text
         assistant = ""
         if len(history) > 0: